@@ -1,31 +1,33 @@
-import datetime
-import json
+import logging
+import os
 import re
-import traceback
-import requests
-from bs4 import BeautifulSoup
-from flask import Flask, jsonify
+from flask import Flask, Response, json, jsonify, request, stream_with_context
 from flask_cors import CORS
 
+# --- Log level from LOG_LEVEL (DEBUG for per-stop detail, WARNING to keep production quiet) ---
+#     Set before the departures import, as opening the stores can log a migration
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+log = logging.getLogger('app')
 
-app = Flask(__name__)
-CORS(app) # Enable CORS for all routes (important for your Vue app)
+import metrics
+from departures import nowUTC, nowLocal, client, stops_data, trips_data, stop_planner, snapshot_writer, stop_groups, drop_departed, get_departures, get_group_departures
+from snapshots import Refresher
+from sharedstore import SnapshotStore, RefreshLock, SharedRefresher
+from responses import ResponseCache
+from board import HEADER, departure_lines
 
-#Starting Logging
 
-def nowUTC():
-    """returns current UTC time as timezone aware datetime"""
-    return datetime.datetime.now(datetime.UTC)
+app = Flask(__name__)
+CORS(app, expose_headers=['X-Stale', 'X-Snapshot-Age']) # Enable CORS for all routes (important for your Vue app)
 
-def nowLocal():
-    """returns current local time as timezone aware datetime"""
-    return datetime.datetime.now().astimezone()
+#Starting Logging
 
 scriptstart = nowUTC()
 LOG_LOCATION = '_logs/'
 log_file = LOG_LOCATION + scriptstart.strftime('%Y-%m-%d %H-%M-%S') + '.log'
+metrics.recorder.log_path = log_file # one json line per refresh, with its stage timings
 
-print(nowLocal(), "Script Start")
+log.info("Script Start")
 
 def alivetime():
     """returns how long the script has been running"""
@@ -55,443 +57,16 @@ def check_time_format(time_string):
 
 
 
-headers = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36',
-}
-
-bus_station_stops = ['1090BSTN01',
-                    '1090BSTN02',
-                    '1090BSTN03',
-                    '1090BSTN04',
-                    '1090BSTN05',
-                    '1090BSTN06',
-                    '1090BSTN07',
-                    '1090BSTN08',
-                    '1090BSTN09',
-                    '1090BSTN10',
-                    '1090BSTN11',
-                    '1090BSTN12',
-                    '1090BSTN13',
-                    '1090BSTN14',
-                    '1090BSTN15',
-                    '1090BSTN16',
-                    '1090BSTN17',
-                    '1090BSTN18',
-                    '1090BSTN19',
-                    '1090BSTN20',
-                    '1090BSTN21',
-                    '1090BSTN22',
-                    '1090BSTN23',
-                    '1090BSTN24',
-                    '1090BSTN25',
-                    '109000022166',
-                    '109000009330',
-                    '109000022155',
-                    '109000022165']
-
-bus_station_request =   {
-    '109GDDCCBS01':{
-        'type':'station'
-    },
-    '109000022150':{},
-    '109000022155':{
-        'filter': {
-            'type':'is_not',
-            'key':'destination_stop/atco_code',
-            'value':bus_station_stops
-        }
-    }
-}
-
-cathedral_quarter_request = {
-    '109000009334':{},
-    '1090DDVS1302':{},
-    '1090DDVS1224':{},
-    '109000022164':{},
-    '109000022165':{},
-    '109000022171':{
-        'filter':{
-            'type':'is_not',
-            'key':'destination_stop/atco_code',
-            'value':bus_station_stops
-        }
-    }
-}
-
-def get_departures(stops_request = None):
-    """gets bus departures from specified stops"""
-
-    # --- Sets default stops for function if none are specified ---
-    if stops_request is None:
-        stops_request = cathedral_quarter_request
-
-    stops_request_data = {}
-
-    # --- Opens and store _data/stops.json ---
-    #     This contains previously fetched metadata about the stops
-    try:
-        with open('_data/stops.json', encoding="utf-8") as f:
-            stops_data = json.loads(f.read())
-        print(nowLocal(), "Successfully loaded _data/stops.json")
-        print(nowLocal(), json.dumps(stops_data, indent=4, default=str))
-    except (json.JSONDecodeError, FileNotFoundError):
-        stops_data = {}
-
-
-    # --- Opens and store _data/trips.json ---
-    #     This contains previously fetched metadata about the individual journeys
-    try:
-        with open('_data/trips.json', encoding="utf-8") as f:
-            trips_data = json.loads(f.read())
-        print(nowLocal(), "Successfully loaded _data/trips.json")
-    except (json.JSONDecodeError, FileNotFoundError):
-        trips_data = {}
-
-    for stop,extras in stops_request.items():
-        stops_request_data[stop] = {}
-        if extras.get('type') == 'station':    # if the stop is actually a station
-            print("getting departures from "+'https://bustimes.org/stations/'+str(stop)+'/')
-            stops_request_data[stop]['html'] = requests.get('https://bustimes.org/stations/'+str(stop)+'/', headers=headers, timeout=10).text
-
-        else:
-            if stops_data.get(stop) == None or stops_data.get(stop).get('long_name') == None:
-                print("getting metadata from "+'https://bustimes.org/api/stops/'+str(stop)+'/?format=json')     # Gets stop metadata if it doesn't already exist
-                stops_request_data[stop] = json.loads(requests.get('https://bustimes.org/api/stops/'+str(stop)+'/?format=json', headers=headers, timeout=10).text)
-            else:
-                stops_request_data[stop] = stops_data[stop]
-            print("getting departures from "+'https://bustimes.org/stops/'+str(stop)+'/')                         # Gets departure page
-            stops_request_data[stop]['html'] = requests.get('https://bustimes.org/stops/'+str(stop)+'/', headers=headers, timeout=10).text
-
-        stops_request_data[stop]['extras'] = extras
-
-        stops_data[stop] = stops_request_data[stop]
-
-    departures_full_data = []
-    departures_summary = []
-
-
-    for stop,info in stops_request_data.items():
-        soup = BeautifulSoup(info['html'], 'html.parser')
-        print('parcing departures for',stop,info.get('long_name') or '(Stop Name Not Found)')
-        try:
-            for i in soup.findAll(id='departures'):
-                for j in i.findAll('table'):
-                    for l in j.findAll('tr'):
-                        if l == j.findAll('tr')[0]:
-                            table_headers = []
-                            for m in l.findAll('th'):
-                                table_headers.append(m.text.strip())
-                            #print(table_headers)
-                            continue
-                        try:
-                            departure = {}
-                            departure['display'] = {}
-                            departure['service'] = {}
-                            departure['stop'] = {'icon': None,
-                                                    'indicator': None,
-                                                    'bay': None}
-                            departure['stop'].update(info)
-
-                            departure['page_service'] = {
-                                    'slug' : l.findAll('td')[0].a['href'].replace('/services/',''),
-                                    'line_name' : l.findAll('td')[0].a.text
-                                }
-                            departure['page_destination'] = l.findAll('td')[1].text.strip()
-                            departure['page_scheduled'] = l.findAll('td')[2].text.strip()
-
-                            departure['page_trip_id'] = l.findAll('td')[2].a['href'].replace('/trips/','')
-
-                            try:
-                                departure['trip'] =  trips_data[departure['page_trip_id']]
-                            except KeyError:
-                                print("getting trip data from "+'https://bustimes.org/api/trips/'+departure['page_trip_id']+'/?format=json')
-                                trips_data[departure['page_trip_id']] = json.loads(requests.get('https://bustimes.org/api/trips/'+departure['page_trip_id']+'/?format=json', headers=headers, timeout=10).text)
-                                departure['trip'] = trips_data[departure['page_trip_id']]
-
-                            destination_id = str(departure['trip']['times'][-1]['stop']['atco_code'])
-
-                            try:
-                                departure['destination_stop'] =  stops_data[destination_id]
-                            except KeyError:
-                                print("getting stop metadata from "+'https://bustimes.org/api/stops/'+str(destination_id)+'/?format=json')
-                                departure['destination_stop'] = json.loads(requests.get('https://bustimes.org/api/stops/'+str(destination_id)+'/?format=json', headers=headers, timeout=10).text)
-                                stops_data[destination_id] = departure['destination_stop']
-
-                            #Destination Filter
-                            try:
-                                if info['extras']['filter']['key'] == 'destination_stop/atco_code':
-                                    #print(info['extras']['filter']['key'])
-                                    if info['extras']['filter']['type'] == 'is_not':
-                                        #print(info['extras']['filter']['type'])
-                                        if departure['destination_stop']['atco_code'] in info['extras']['filter']['value']:
-                                            #print(departure['destination_stop']['atco_code'], info['extras']['filter']['value'])
-                                            continue
-                            except KeyError:
-                                pass
-
-                            departure['display']['destination'] = departure['destination_stop']['name'].replace(' '+departure['destination_stop']['common_name'],', '+departure['destination_stop']['common_name']).replace(' Town Ctr','')
-                            departure['display']['via'] = None
-                            departure['display']['notes'] = None
-                            departure['page_expected'] = None
-
-                            try:
-                                if table_headers[2] == 'Ex\xadpected':
-                                    departure['page_expected'] = l.findAll('td')[3].text.strip()
-                                    try:
-                                        if table_headers[3] == 'Bay':
-                                            departure['stop']['bay'] = l.findAll('td')[4].text.strip()
-                                    except IndexError:
-                                        pass
-                                elif table_headers[2] == 'Bay':
-                                    departure['stop']['bay'] = l.findAll('td')[3].text.strip()
-                            except IndexError:
-                                pass
-
-                            # NEW: Revised logic for page_scheduled_dt to handle day rollover
-                            scheduled_dt_today = datetime.datetime.strptime(
-                                nowLocal().strftime('%Y-%m-%d ') + departure['page_scheduled'],
-                                '%Y-%m-%d %H:%M'
-                            ).astimezone()
-
-                            if scheduled_dt_today < nowLocal():
-                                departure['page_scheduled_dt'] = scheduled_dt_today + datetime.timedelta(days=1)
-                            else:
-                                departure['page_scheduled_dt'] = scheduled_dt_today
-
-                            # NEW: Revised logic for page_expected_dt to handle day rollover
-                            try:
-                                expected_dt_today = datetime.datetime.strptime(
-                                    nowLocal().strftime('%Y-%m-%d ') + departure['page_expected'],
-                                    '%Y-%m-%d %H:%M'
-                                ).astimezone()
-
-                                if expected_dt_today < nowLocal():
-                                    departure['page_expected_dt'] = expected_dt_today + datetime.timedelta(days=1)
-                                else:
-                                    departure['page_expected_dt'] = expected_dt_today
-                            except (TypeError, KeyError, ValueError):
-                                # If expected time is missing or invalid, default to scheduled time (already correctly dated)
-                                departure['page_expected_dt'] = departure['page_scheduled_dt']
-
-
-                            timing_points_list = list(filter(lambda d: d['timing_status'] in ['PTP'], departure['trip']['times']))
-                            timing_points_data = {}
-
-                            if timing_points_list[0]['stop']['atco_code'] == timing_points_list[-1]['stop']['atco_code']:
-                                departure['circular'] = True
-                            else:
-                                departure['circuar'] = None
-
-                            for i in timing_points_list:
-                                try:
-                                    timing_points_data[i['stop']['atco_code']] = stops_data[i['stop']['atco_code']]
-                                except KeyError:
-                                    print("getting data from "+'https://bustimes.org/api/stops/'+str(i['stop']['atco_code'])+'/?format=json')
-                                    stops_data[i['stop']['atco_code']] = json.loads(requests.get('https://bustimes.org/api/stops/'+str(i['stop']['atco_code'])+'/?format=json', headers=headers, timeout=10).text)
-                                    timing_points_data[i['stop']['atco_code']] = stops_data[i['stop']['atco_code']]
-
-                            departure['timing_points_data'] = timing_points_data
-                            via_calc = []
-
-                            for tp_stop, tp_info in departure['timing_points_data'].items():
-                                tp = {}
-                                for i in departure['trip']['times']:
-                                    try:
-                                        if i['stop']['atco_code'] == tp_info['atco_code']:
-                                            tp = i
-                                            #break
-                                    except KeyError:
-                                        pass
-                                try:
-                                    # This logic for 'aimed_departure_time_dt' and 'aimed_arrival_time_dt' should also be updated
-                                    # to use the new more robust date assignment to be consistent.
-                                    # For now, it's not the primary concern for the main departure list sorting.
-                                    if datetime.datetime.strptime(nowLocal().strftime('%x ')+tp['aimed_departure_time'],'%x %H:%M').astimezone() > nowLocal():
-                                        tp['aimed_departure_time_dt'] = datetime.datetime.strptime(nowLocal().strftime('%x ')+tp['aimed_departure_time'],'%x %H:%M').astimezone()
-                                    elif datetime.datetime.strptime(nowLocal().strftime('%x ')+tp['aimed_departure_time'],'%x %H:%M').astimezone() > nowLocal()-datetime.timedelta(hours=12):
-                                        tp['aimed_departure_time_dt'] = datetime.datetime.strptime(nowLocal().strftime('%x ')+tp['aimed_departure_time'],'%x %H:%M').astimezone()
-                                    else:
-                                        tp['aimed_departure_time_dt'] = datetime.datetime.strptime((nowLocal()+datetime.timedelta(days=1)).strftime('%x ')+tp['aimed_departure_time'],'%x %H:%M').astimezone()
-
-                                    if tp['aimed_departure_time_dt'] >= departure['page_scheduled_dt']:
-                                        via_calc.append({'atco_code':tp_info['atco_code'],'common_name':tp_info['common_name'],'name':tp_info['name'],'time_dt':tp['aimed_departure_time_dt']})
-
-                                except TypeError:
-                                    if datetime.datetime.strptime(nowLocal().strftime('%x ')+tp['aimed_arrival_time'],'%x %H:%M').astimezone() > nowLocal():
-                                        tp['aimed_arrival_time_dt'] = datetime.datetime.strptime(nowLocal().strftime('%x ')+tp['aimed_arrival_time'],'%x %H:%M').astimezone()
-                                    elif datetime.datetime.strptime(nowLocal().strftime('%x ')+tp['aimed_arrival_time'],'%x %H:%M').astimezone() > nowLocal()-datetime.timedelta(hours=12):
-                                        tp['aimed_arrival_time_dt'] = datetime.datetime.strptime(nowLocal().strftime('%x ')+tp['aimed_arrival_time'],'%x %H:%M').astimezone()
-                                    else:
-                                        tp['aimed_arrival_time_dt'] = datetime.datetime.strptime((nowLocal()+datetime.timedelta(days=1)).strftime('%x ')+tp['aimed_arrival_time'],'%x %H:%M').astimezone()
-
-                                    if tp['aimed_arrival_time_dt'] >= departure['page_scheduled_dt']:
-                                        via_calc.append({'atco_code':tp_info['atco_code'],'common_name':tp_info['common_name'],'name':tp_info['name'],'time_dt':tp['aimed_arrival_time_dt']})
-
-                                except KeyError:
-                                    pass
-
-                            via_calc = sorted(via_calc, key=lambda x: (x['time_dt']))
-                            via_calc = via_calc[:-1]
-                            via_atco = []
-                            for i in via_calc:
-                                via_atco.append(i['atco_code'])
-                            departure['via_atco'] = via_atco
-                            via_text = ''
-
-                            for i in via_calc:
-                                if i == via_calc[-1]:
-                                    via_text+=' & '+i['common_name']
-                                elif i == via_calc[-2]:
-                                    via_text+=i['common_name']
-                                else:
-                                    via_text+=i['common_name']+', '
-                            #print(via_text)
-
-
-                            if '8-derby-mackworth' in departure['page_service']['slug']:
-                                departure['display']['destination'] = 'Mackworth Estate, Henley Green'
-                                departure['display']['via'] = 'Slack Lane'
-                            elif 'ta-derby-allestree' in departure['page_service']['slug']:
-                                departure['service']['line_name'] = 'The Allestree'
-                                if via_atco == ['109000009153', '109000008741', '109000008787', '109000008732', '109000009152']:
-                                    departure['display']['destination'] = 'Allestree'
-                                    departure['display']['via'] = 'University, then the Green Route'
-                                elif via_atco == ['109000009153', '109000008741', '109000008792', '109000008787', '109000008732', '109000009152']:
-                                    departure['display']['destination'] = 'Allestree, Woodlands Top'
-                                    departure['display']['via'] = 'University, then the Green Route'
-                                elif via_atco == ['109000009153', '109000008731', '109000008788', '109000008742', '109000009152']:
-                                    departure['display']['destination'] = 'Allestree'
-                                    departure['display']['via'] = 'University, then the Blue Route'
-                                elif via_atco == ['109000009153', '109000008731', '109000008788', '109000008791', '109000008742', '109000009152']:
-                                    departure['display']['destination'] = 'Allestree, Woodlands Top'
-                                    departure['display']['via'] = 'University, then the Blue Route'
-                            elif 'tm-derby-mickleover' in departure['page_service']['slug']:
-                                departure['service']['line_name'] = 'The Mickleover'
-                                if via_atco == ['109000009011', '109000008906', '109000008931', '109000008939', '109000009012']:
-                                    departure['display']['destination'] = 'Mickleover'
-                                    departure['display']['via'] = 'Royal Derby Hospital, then the Green Route'
-                                elif via_atco == ['109000009011', '109000008938', '109000008930', '109000008903', '109000009012']:
-                                    departure['display']['destination'] = 'Mickleover'
-                                    departure['display']['via'] = 'Royal Derby Hospital, then the Blue Route'
-
-                            elif 'sky-skylink-derby-leicester-loughborough-east-midl' in departure['page_service']['slug']:
-                                if departure['destination_stop']['atco_code'] in ['269030091']:
-                                    departure['display']['via'] = 'East Mids Airport & Loughborough'
-                                elif departure['destination_stop']['atco_code'] in ['260007333','260007201']:
-                                    departure['display']['via'] = 'East Mids Airport'
-
-                            elif via_atco == [ "1090BSTN23","1000DOOL4017","1000DBWL4005", "1000DBGA4002","1000DBLC3994","100000022178","1000DMTS1132","1000DDMR3919","109000008802" ]:
-                                departure['display']['destination'] = 'Belper Estates fast'
-                                departure['display']['via'] = 'A38 to Kilburn Toll Bar'
-                                departure['display']['notes'] = 'Returns to Derby as 6.4 via Duffield'
-
-                            elif via_atco == ["109000008733","1000DQCR5878", "1000DKKR5663","1000DWUB5665","1000DCOH5839","1000DHWAR708", "1000DBAR5814","1000DAPA4644"]:
-                                departure['display']['via'] = 'Quarndon & Hulland Ward'
-                            elif via_atco == ["1090BSTN23", "1000DOOL4017", "1000DBWL4005","1000DBGA4002","1000DBLC3994"]:
-                                departure['display']['via'] = 'A38 & Belper Estates'
-                            elif via_atco == [ "109000022165", "1090DDAR1606", "1000DLEB4088","1000DCAR1608", "1000DHTS1676","1000DBSB4119","1000DOSL1819","1000DBKR4038" ]:
-                                departure['display']['via'] = 'Little Eaton & Holbrook'
-
-                            elif via_atco == ["1090BSTN25","43000105509","490008016CS","490016736W", "450032500"]:
-                                departure['display']['via'] = 'Birmingham Airport and Heathrow Central'
-                            elif via_atco == (["1090BSTN25","3390UN04","3390BB10","269030094","049000000804","02900033","02900065","490008016CS","49001643011","4400CY0375"] or ["1090BSTN25","3390UN04","3390BB10","269030094","049000000804","02900033","02900065","490008016CS","49001643011","4400CY0375"]):
-                                departure['display']['via'] = 'Milton Keynes Coachway, Luton Airport & Heathrow Airport'
-                            elif via_atco == ["1090BSTN25","1000DCBSB267","370010217","370010201","450027815","450032500" ]:
-                                departure['display']['via'] = 'Sheffield & Leeds'
-                            elif via_atco ==  [ "1090BSTN25", "269030094","269046004","490000082C","49000144CSZ"] :
-                                departure['display']['via'] = 'Finchley Road'
-                            elif via_atco == [ "1090BSTN25", "3390UN04", "3390BB10","269030094", "049000000804", "02900033","02900065", "490008016CS","490000104WH"]:
-                                departure['display']['via'] = 'Milton Keynes Coachway & Luton Airport'
-
-                            #else:
-                                #departure['display']['via'] = via_text
-
-
-                            if departure['page_service']['slug'] == 'v1-derby-etwall-hilton-hatton-tutbury-rolleston-2' and departure['destination_stop']['atco_code'] in ['3800C302701','3800C303200','3800C303900']:
-                                departure['display']['via'] = 'Tutbury'
-                            elif departure['page_service']['slug'] == 'v3-derby-littleover-findern-willington-repton-ne-3' and departure['destination_stop']['atco_code'] in ['3800C302700']:
-                                departure['display']['via'] = 'Willington'
-                            if departure['destination_stop']['atco_code'] in ['49001643011']:
-                                departure['display']['destination'] = 'Heathrow Airport, Terminal 5'
-                            elif departure['destination_stop']['atco_code'] in ['490016736W']:
-                                departure['display']['destination'] = 'London Victoria, Coach Station'
-
-
-                            departures_full_data.append(departure)
-
-                        except Exception as e: # <--- NEW INNER EXCEPT BLOCK
-                            print(f"Error processing departure row for stop {stop}: {e}")
-                            print(traceback.format_exc()) # <--- Log the full traceback for this row
-                            continue
-        except Exception as e: # <--- REPLACE YOUR 'except AttributeError:' with this.
-            print(f"General scraping error for stop {stop}: {e}")
-            print(traceback.format_exc()) # <--- THIS IS THE NEW IMPORTANT LINE
-    #print(json.dumps(stops_request_data, indent=4))
-    #print(json.dumps(departures_full_data, indent=4))
-
-    for d in departures_full_data:
-        departure = {
-            'stop' : {'indicator':d['stop']['indicator'],'icon':d['stop']['icon'],'bay':d['stop']['bay']},
-            'service' : d['page_service']['line_name'],
-            'destination' : d['display']['destination'],
-            'via': d['display']['via'],
-            'notes': d['display']['notes'],
-            'scheduled' : d['page_scheduled'],
-            'scheduled_dt' : d['page_scheduled_dt'],
-            'expected' : d['page_expected'],
-            'operator' : d['trip']['operator']['name'],
-            'expected_dt': d['page_expected_dt'],
-            'debug': ''#d['page_trip_id']
-
-        }
-        departures_summary.append(departure)
-
-    # NEW: Filter out departures where expected_dt is too far in the past
-    current_time = nowLocal()
-    filtered_departures_summary = []
-    for departure in departures_summary:
-        # If the expected time is more than 5 minutes in the past, don't show it.
-        # This removes buses that have already departed or are severely delayed past relevance.
-        if departure['expected_dt'] >= (current_time - datetime.timedelta(minutes=5)):
-            filtered_departures_summary.append(departure)
-
-    departures_summary = sorted(filtered_departures_summary, key=lambda x: (x['expected_dt']))
-
-    with open('_data/departures full.json',"w", encoding="utf-8") as f:
-        f.write(json.dumps(departures_full_data, indent=4, default=str))
-
-    with open('_data/departures sumary.json',"w", encoding="utf-8") as f:
-        f.write(json.dumps(departures_summary, indent=4, sort_keys=True, default=str))
-
-    with open('_data/stops.json',"w", encoding="utf-8") as f:
-        f.write(json.dumps(stops_data, indent=4, default=str))
-
-    with open('_data/trips.json',"w", encoding="utf-8") as f:
-        f.write(json.dumps(trips_data, indent=4, default=str))
-
-    return departures_summary
-
 def printDepartures(limit=15, request = None ):
-    """prints departures in an easy to read table"""
+    """prints departures in an easy to read table, scraping them afresh (board.py redraws from the cached snapshots)"""
     if request is None:
-        request = cathedral_quarter_request
+        request = stop_groups['cathedral_quarter']['stops']
 
     departures = get_departures(request)
-    print("-"*128)
-    print("| STOP | SERVICE |                                                    DESTINATION |  SCH  |  EST  |                   OPERATOR |")
-    print("-"*128)
+    print('\n'.join(HEADER))
 
-    for x in range(limit):
-        try:
-            i = departures[x]
-        except IndexError:
-            break
-        print("| %5s | %6s | %62s | %5s | %5s | %26s | %1s" %(i['stop']['icon'] or i['stop']['indicator'] or i['stop']['bay'], i['service'], i['destination'], i['scheduled'], i['expected'] or '', i['operator'], i['debug']))
-        if i['via'] != None:
-            print("| %5s | %6s | %62s | %5s | %5s | %26s |" %( '', '', 'via '+i['via'], '', '', ''))
-        if i['notes'] != None:
-            print("| %5s | %6s | %62s | %5s | %5s | %26s |" %( '', '', i['notes'], '', '', ''))
-        print("| %5s | %6s | %62s | %5s | %5s | %26s |" %( '', '', '', '', '', ''))
+    for i in departures[:limit]:
+        print('\n'.join(departure_lines(i)))
     print("-"*128)
     print('%127s' %('Data From bustimes.org - Last Updated '+str(nowLocal().strftime('%Y-%m-%d %X'))))
 
@@ -501,36 +76,196 @@ def hello_flask():
     """Simple API test endpoint. Frontend will route differently."""
     return "Hello from Flask! API is running."
 
-# NEW: Endpoint for Cathedral Quarter departures (uses the renamed variable)
-@app.route('/departures/cathedral_quarter')
-def get_cathedral_quarter_departures_api():
-    """Pass Cathedral Quarter departures data to API."""
+# --- Background refresh of each stop group ---
+#     The routes below serve the latest prebuilt snapshot rather than scraping per hit.
+#     Groups due at the same time are refreshed together so shared stops are scraped once.
+#     If bustimes.org fails, the last good snapshot is served marked stale, dropping buses as they go.
+#     Under several workers (see gunicorn.conf.py) only the one holding the refresh lock scrapes,
+#     the others serve the snapshots it publishes to the shared store.
+SNAPSHOTS_PATH = '_data/snapshots.db'
+REFRESH_LOCK_PATH = '_data/refresher.lock'
+
+local_refresher = Refresher(get_group_departures, expire=drop_departed)
+for name,group in stop_groups.items():
+    local_refresher.add_group(name, group, group['interval'])
+refresher = SharedRefresher(local_refresher, SnapshotStore(SNAPSHOTS_PATH, dumps=app.json.dumps, loads=app.json.loads), RefreshLock(REFRESH_LOCK_PATH))
+
+# --- Each snapshot is encoded once, with gzip/brotli copies and the common ?limit= board sizes ---
+response_cache = ResponseCache(lambda departures: app.json.dumps(departures, separators=(',', ':'))) # as jsonify outside debug
+
+def departures_response(group, limit=None):
+    """returns the cached snapshot for a stop group, pre-encoded and compressed, with caching headers"""
+    refresher.start()
+    snapshot = refresher.get(group)
+    rendered = response_cache.get(group, snapshot, limit)
+    encoding, body, etag = rendered.select(request.accept_encodings)
+    response = Response(body, mimetype='application/json')
+    if encoding != 'identity':
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = True
+    response.set_etag(etag)
+    response.last_modified = snapshot.modified_at
+    response.headers['X-Snapshot-Age'] = '%.3f' % snapshot.age
+    response.headers['X-Refresh-Duration'] = '%.3f' % snapshot.duration
+    response.headers['X-Stale'] = 'true' if snapshot.stale else 'false'
+    response = response.make_conditional(request)
+    response_cache.count(encoding, response.status_code == 304)
+    return response
+
+@app.route('/status')
+def get_status_api():
+    """Snapshot age and refresh duration for every stop group."""
+    refresher.start()
+    last = metrics.recorder.last
+    return jsonify({'uptime': alivetime(), 'pid': os.getpid(), 'role': refresher.role, 'groups': refresher.status(), 'upstream': client.counters(), 'circuit': client.breaker.status(), 'stops': stops_data.counters(), 'trips': trips_data.counters(), 'persistence': snapshot_writer.counters(), 'responses': response_cache.counters(), 'stop_pages': stop_planner.status(nowLocal()), 'last_refresh': last.as_dict() if last else None})
+
+def hit_ratio(stats):
+    """returns a cache's hit ratio, or None before any lookups"""
+    lookups = stats['hits'] + stats['misses']
+    return stats['hits'] / lookups if lookups else None
+
+def refresher_metric_families():
+    """collects the pipeline, upstream and cache counters of refreshing as prometheus metric families"""
+    recorder = metrics.recorder
+    upstream = client.counters()
+    caches = {'stops': stops_data.counters(), 'trips': trips_data.counters()}
+    return [
+        ('departures_refreshes_total', 'counter', 'Refreshes run, including failed ones.',
+            [({}, recorder.refreshes)]),
+        ('departures_refresh_errors_total', 'counter', 'Refreshes that raised.',
+            [({}, recorder.errors)]),
+        ('departures_refresh_seconds_total', 'counter', 'Time spent refreshing.',
+            [({}, recorder.refresh_seconds)]),
+        ('departures_stage_seconds_total', 'counter', 'Time spent in each stage of a refresh.',
+            [({'stage': stage}, seconds) for stage, seconds in sorted(recorder.stage_seconds.items())]),
+        ('departures_stage_calls_total', 'counter', 'Times each stage of a refresh ran.',
+            [({'stage': stage}, calls) for stage, calls in sorted(recorder.stage_calls.items())]),
+        ('departures_refresh_items_total', 'counter', 'Pages, trips, stops and departures handled by refreshes.',
+            [({'item': item}, n) for item, n in sorted(recorder.counts.items())]),
+        ('bustimes_requests_total', 'counter', 'Requests to bustimes.org by endpoint and response status.',
+            [({'endpoint': endpoint, 'status': status}, n) for endpoint, stats in sorted(upstream.items()) for status, n in sorted(stats['statuses'].items())]),
+        ('bustimes_request_seconds_total', 'counter', 'Time spent waiting on bustimes.org by endpoint.',
+            [({'endpoint': endpoint}, stats['seconds']) for endpoint, stats in sorted(upstream.items())]),
+        ('bustimes_retries_total', 'counter', 'Retried requests to bustimes.org by endpoint.',
+            [({'endpoint': endpoint}, stats['retries']) for endpoint, stats in sorted(upstream.items())]),
+        ('bustimes_not_modified_total', 'counter', 'Conditional requests answered with 304 by endpoint.',
+            [({'endpoint': endpoint}, stats['not_modified']) for endpoint, stats in sorted(upstream.items())]),
+        ('bustimes_short_circuited_total', 'counter', 'Requests to bustimes.org refused by the open circuit breaker.',
+            [({'endpoint': endpoint}, stats['short_circuited']) for endpoint, stats in sorted(upstream.items())]),
+        ('bustimes_circuit_open', 'gauge', 'Whether the circuit breaker is holding requests to bustimes.org back.',
+            [({}, client.breaker.status()['state'] != 'closed')]),
+        ('bustimes_circuit_trips_total', 'counter', 'Times the circuit breaker has opened.',
+            [({}, client.breaker.trips)]),
+        ('departures_cache_lookups_total', 'counter', 'Stop and trip cache lookups by result.',
+            [({'cache': cache, 'result': result}, stats[key]) for cache, stats in caches.items() for result, key in (('hit', 'hits'), ('miss', 'misses'))]),
+        ('departures_cache_hit_ratio', 'gauge', 'Share of cache lookups that were hits.',
+            [({'cache': cache}, hit_ratio(stats)) for cache, stats in caches.items()]),
+        ('departures_cache_entries', 'gauge', 'Entries held in each cache.',
+            [({'cache': cache}, stats['entries']) for cache, stats in caches.items()]),
+        ('departures_persist_total', 'counter', 'Snapshot dump writes by outcome.',
+            [({'result': result}, n) for result, n in snapshot_writer.counters().items()]),
+    ]
+
+def worker_metric_families():
+    """collects this worker's own uptime, role and response counters as prometheus metric families"""
+    return [
+        ('departures_uptime_seconds', 'gauge', 'Seconds since this worker started.',
+            [({}, (nowUTC() - scriptstart).total_seconds())]),
+        ('departures_refresher', 'gauge', 'Whether this worker is the one refreshing the snapshots.',
+            [({}, refresher.role == 'refresher')]),
+        ('departures_responses_total', 'counter', 'Departures responses sent by content encoding, or as 304 not modified.',
+            [({'encoding': encoding}, n) for encoding, n in sorted(response_cache.served.items())]),
+        ('departures_response_renders_total', 'counter', 'Snapshots encoded for responses, and views encoded per request for uncommon limits.',
+            [({'view': view}, response_cache.stats[view]) for view in ('renders', 'uncached')]),
+    ]
+
+# --- Published to the shared store every poll, so every worker's /metrics serves the same counters ---
+refresher.refresher_metrics = refresher_metric_families
+refresher.worker_metrics = worker_metric_families
+
+def metric_families():
+    """collects the refresher's counters, every worker's, and each snapshot's gauges as prometheus metric families
+
+    The refresher's counters are read back as the refreshing worker last
+    published them, and each worker's own are labelled with its pid, so
+    whichever worker answers a scrape the _total counters don't jump.
+    """
+    groups = refresher.status()
+    return refresher.metric_families() + [
+        ('departures_snapshot_age_seconds', 'gauge', 'Age of each stop group snapshot.',
+            [({'group': name}, status['age']) for name, status in groups.items()]),
+        ('departures_snapshot_refresh_seconds', 'gauge', 'How long the latest snapshot took to build.',
+            [({'group': name}, status['refresh_duration']) for name, status in groups.items()]),
+        ('departures_snapshot_stale', 'gauge', 'Whether each stop group is serving its last good snapshot after a failed refresh.',
+            [({'group': name}, status['stale']) for name, status in groups.items()]),
+        ('departures_snapshot_departures', 'gauge', 'Departures in each stop group snapshot.',
+            [({'group': name}, status['departures']) for name, status in groups.items()]),
+    ]
+
+@app.route('/metrics')
+def get_metrics_api():
+    """Prometheus metrics for the scrape pipeline, upstream requests and caches, the same from any worker."""
+    refresher.start()
+    return Response(metrics.render(metric_families()), mimetype='text/plain; version=0.0.4')
+
+@app.route('/departures/<group>')
+def get_group_departures_api(group):
+    """Pass a stop group's departures data to API, the first ?limit= of them if given."""
+    if group not in stop_groups:
+        return jsonify({"error": "Unknown stop group", "message": "No stop group called " + group}), 404
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        return jsonify({"error": "Invalid limit", "message": "limit must be a positive number of departures"}), 400
     try:
-        departures_data = get_departures(cathedral_quarter_request)
-        return jsonify(departures_data)
+        return departures_response(group, limit)
     except Exception as e:
-        print(f"Error fetching Cathedral Quarter departures: {e}")
-        print(traceback.format_exc())
-        return jsonify({"error": str(e), "message": "Could not fetch Cathedral Quarter departures"}), 500
-
-# NEW: Endpoint for Bus Station departures (uses the existing variable)
-@app.route('/departures/bus_station')
-def get_bus_station_departures_api():
-    """Pass Bus Station departures data to API."""
+        log.exception("Error fetching %s departures: %s", group, e)
+        return jsonify({"error": str(e), "message": f"Could not fetch {group} departures"}), 500
+
+# --- Push updates for a stop group as server-sent events ---
+#     Clients get the whole snapshot once, then only the keyed changes after each refresh
+STREAM_KEEPALIVE = 25
+
+def sse(event, data):
+    """formats a server-sent event with a json payload"""
+    return 'event: ' + event + '\ndata: ' + json.dumps(data) + '\n\n'
+
+def snapshot_event(snapshot):
+    """returns the payload of a full snapshot event"""
+    return {'etag': snapshot.etag, 'stale': snapshot.stale, 'refreshed_at': snapshot.refreshed_at.isoformat(), 'departures': snapshot.departures}
+
+@app.route('/departures/<group>/stream')
+def get_group_departures_stream(group):
+    """Stream a stop group's departures, sending diffs as they change."""
+    if group not in stop_groups:
+        return jsonify({"error": "Unknown stop group", "message": "No stop group called " + group}), 404
+    refresher.start()
     try:
-        departures_data = get_departures(bus_station_request)
-        return jsonify(departures_data)
+        snapshot = refresher.get(group)
     except Exception as e:
-        print(f"Error fetching Bus Station departures: {e}")
-        print(traceback.format_exc())
-        return jsonify({"error": str(e), "message": "Could not fetch Bus Station departures"}), 500
+        log.warning("Error fetching %s departures: %s", group, e)
+        return jsonify({"error": str(e), "message": f"Could not fetch {group} departures"}), 500
+
+    def events(snapshot):
+        yield sse('snapshot', snapshot_event(snapshot))
+        while True:
+            latest = refresher.wait_for_change(group, snapshot.etag, timeout=STREAM_KEEPALIVE)
+            if latest is None:
+                yield ': keep-alive\n\n'
+                continue
+            if latest.previous_etag == snapshot.etag:
+                yield sse('diff', dict(latest.diff, etag=latest.etag, stale=latest.stale, refreshed_at=latest.refreshed_at.isoformat()))
+            else:
+                # Missed a refresh in between, so the diff doesn't apply: resend everything
+                yield sse('snapshot', snapshot_event(latest))
+            snapshot = latest
+
+    return Response(stream_with_context(events(snapshot)), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=8000)
 
-#bus_station_request
-#while True:
-#printDepartures(limit=17) # Commented out
-#printDepartures(request = bus_station_request, limit = 10) # Commented out
-#
-#    time.sleep(300)
\ No newline at end of file
+# For a kiosk display, run the boards from the background-refreshed snapshots instead of looping printDepartures:
+#    python board.py cathedral_quarter bus_station --limit 10
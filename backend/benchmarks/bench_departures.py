@@ -0,0 +1,158 @@
+"""benchmarks a full departures refresh offline, replaying recorded bustimes.org responses
+
+Usage, from the backend directory:
+    python benchmarks/bench_departures.py --record             # capture fixtures once, live
+    python benchmarks/bench_departures.py [--latency 0.05] [--repeat 5] [--json]
+
+Fixtures live in benchmarks/fixtures (or --fixtures DIR), one file per url.
+Each group is refreshed from empty stop and trip stores (cold), again with
+them filled (warm), and once more letting the stop planner reuse the pages
+that aren't due yet (incremental). The median wall time and per-stage time
+over the repeats are reported, with upstream requests made and peak traced
+memory from one extra run under tracemalloc.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, here)
+os.chdir(here)
+
+import departures
+import fetcher
+import metrics
+import replay
+from bustimes import BustimesClient
+from stopplanner import StopPlanner
+from stopstore import StopStore
+from tripcache import TripCache
+
+GROUPS = ('bus_station', 'cathedral_quarter')
+CACHES = ('cold', 'warm', 'incremental')
+
+
+def fresh_state(data_dir, adapter):
+    """points the pipeline at empty stores, dumps in data_dir and a new client using adapter"""
+    departures.stops_data = StopStore(os.path.join(data_dir, 'stops.db'), legacy_path=None)
+    departures.trips_data = TripCache(os.path.join(data_dir, 'trips.db'), legacy_path=None)
+    departures.FULL_PATH = os.path.join(data_dir, 'departures full.json')
+    departures.SUMMARY_PATH = os.path.join(data_dir, 'departures sumary.json')
+    departures.client = BustimesClient()
+    departures.stop_planner = StopPlanner()
+    replay.install(departures.client, adapter)
+
+
+def refresh(name, adapter, incremental=False):
+    """runs one refresh of a group, returning its timings and upstream request count
+
+    Every stop page is fetched unless incremental is set.
+    """
+    if not incremental:
+        departures.stop_planner.forget()
+    adapter.reset()
+    started = time.perf_counter()
+    summary = fetcher.unwrap(departures.get_group_departures({name: departures.stop_groups[name]})[name])
+    elapsed = time.perf_counter() - started
+    departures.snapshot_writer.flush()
+    trace = metrics.recorder.last
+    return {
+        'seconds': elapsed,
+        'stages': {stage: seconds for stage, (seconds, calls) in trace.stages.items()},
+        'requests': sum(adapter.requests.values()),
+        'missing': sum(adapter.missing.values()),
+        'departures': len(summary),
+    }
+
+
+def cold_warm_incremental(name, adapter):
+    """refreshes a group from empty stores, then again straight after, then incrementally"""
+    with tempfile.TemporaryDirectory() as data_dir:
+        fresh_state(data_dir, adapter)
+        return refresh(name, adapter), refresh(name, adapter), refresh(name, adapter, incremental=True)
+
+
+def peak_memory(name, adapter):
+    """returns the peak traced memory of a cold, a warm and an incremental refresh, in bytes"""
+    with tempfile.TemporaryDirectory() as data_dir:
+        fresh_state(data_dir, adapter)
+        peaks = []
+        for cache in CACHES:
+            tracemalloc.start()
+            refresh(name, adapter, incremental=cache == 'incremental')
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        return peaks
+
+
+def summarise(runs, peak):
+    """returns the median of a list of refresh results"""
+    stages = sorted({stage for run in runs for stage in run['stages']})
+    return {
+        'seconds': statistics.median(run['seconds'] for run in runs),
+        'stages': {stage: statistics.median(run['stages'].get(stage, 0.0) for run in runs) for stage in stages},
+        'requests': runs[-1]['requests'],
+        'missing': runs[-1]['missing'],
+        'departures': runs[-1]['departures'],
+        'peak_bytes': peak,
+    }
+
+
+def record(groups, fixture_dir):
+    """refreshes each group live from empty stores, saving every response as a fixture"""
+    adapter = replay.RecordingAdapter(fixture_dir)
+    for name in groups:
+        with tempfile.TemporaryDirectory() as data_dir:
+            fresh_state(data_dir, adapter)
+            departures.get_group_departures({name: departures.stop_groups[name]})
+            departures.snapshot_writer.flush()
+    print("Recorded %d responses to %s" % (adapter.recorded, fixture_dir))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fixtures', default=os.path.join(here, 'benchmarks', 'fixtures'))
+    parser.add_argument('--groups', nargs='+', default=list(GROUPS))
+    parser.add_argument('--record', action='store_true', help='capture fixtures from bustimes.org instead of benchmarking')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every replayed request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds, at random')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='print results as json')
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.groups, args.fixtures)
+        return
+    if not os.path.isdir(args.fixtures):
+        sys.exit("No fixtures at "+args.fixtures+", run with --record first")
+
+    adapter = replay.ReplayAdapter(args.fixtures, latency=args.latency, jitter=args.jitter)
+    results = {}
+    for name in args.groups:
+        runs = [cold_warm_incremental(name, adapter) for _ in range(args.repeat)]
+        peaks = peak_memory(name, adapter)
+        results[name] = {cache: summarise([run[i] for run in runs], peaks[i]) for i, cache in enumerate(CACHES)}
+
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    print("%d repeats, %.0f ms replayed latency, medians" % (args.repeat, args.latency * 1000))
+    for name, caches in results.items():
+        for cache, result in caches.items():
+            print()
+            print("%-18s %-11s %8.1f ms  %4d requests  %4d departures  %7.2f MiB peak" % (
+                name, cache, result['seconds'] * 1000, result['requests'], result['departures'], result['peak_bytes'] / 2**20))
+            for stage, seconds in result['stages'].items():
+                print("    %-16s %8.1f ms" % (stage, seconds * 1000))
+            if result['missing']:
+                print("    %d requests had no fixture, re-record with --record" % result['missing'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""benchmarks the display-rule engine against the if/elif chain it replaced
+
+Usage, from the backend directory:
+    python benchmarks/bench_rules.py ["_data/departures full.json"] [--repeat N]
+
+Departures are read from a captured departures full.json (written by every
+refresh), with one extra departure per rule case so every rule is hit. Both
+implementations are run over the same departures, checked to agree, and
+timed.
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import Departure
+from rules import DisplayRules
+
+
+def legacy_display_rules(departure, via_atco):
+    """the original hand-written override chain from get_departures, kept for comparison"""
+    if '8-derby-mackworth' in departure['page_service']['slug']:
+        departure['display']['destination'] = 'Mackworth Estate, Henley Green'
+        departure['display']['via'] = 'Slack Lane'
+    elif 'ta-derby-allestree' in departure['page_service']['slug']:
+        departure['service']['line_name'] = 'The Allestree'
+        if via_atco == ['109000009153', '109000008741', '109000008787', '109000008732', '109000009152']:
+            departure['display']['destination'] = 'Allestree'
+            departure['display']['via'] = 'University, then the Green Route'
+        elif via_atco == ['109000009153', '109000008741', '109000008792', '109000008787', '109000008732', '109000009152']:
+            departure['display']['destination'] = 'Allestree, Woodlands Top'
+            departure['display']['via'] = 'University, then the Green Route'
+        elif via_atco == ['109000009153', '109000008731', '109000008788', '109000008742', '109000009152']:
+            departure['display']['destination'] = 'Allestree'
+            departure['display']['via'] = 'University, then the Blue Route'
+        elif via_atco == ['109000009153', '109000008731', '109000008788', '109000008791', '109000008742', '109000009152']:
+            departure['display']['destination'] = 'Allestree, Woodlands Top'
+            departure['display']['via'] = 'University, then the Blue Route'
+    elif 'tm-derby-mickleover' in departure['page_service']['slug']:
+        departure['service']['line_name'] = 'The Mickleover'
+        if via_atco == ['109000009011', '109000008906', '109000008931', '109000008939', '109000009012']:
+            departure['display']['destination'] = 'Mickleover'
+            departure['display']['via'] = 'Royal Derby Hospital, then the Green Route'
+        elif via_atco == ['109000009011', '109000008938', '109000008930', '109000008903', '109000009012']:
+            departure['display']['destination'] = 'Mickleover'
+            departure['display']['via'] = 'Royal Derby Hospital, then the Blue Route'
+
+    elif 'sky-skylink-derby-leicester-loughborough-east-midl' in departure['page_service']['slug']:
+        if departure['destination_stop']['atco_code'] in ['269030091']:
+            departure['display']['via'] = 'East Mids Airport & Loughborough'
+        elif departure['destination_stop']['atco_code'] in ['260007333','260007201']:
+            departure['display']['via'] = 'East Mids Airport'
+
+    elif via_atco == [ "1090BSTN23","1000DOOL4017","1000DBWL4005", "1000DBGA4002","1000DBLC3994","100000022178","1000DMTS1132","1000DDMR3919","109000008802" ]:
+        departure['display']['destination'] = 'Belper Estates fast'
+        departure['display']['via'] = 'A38 to Kilburn Toll Bar'
+        departure['display']['notes'] = 'Returns to Derby as 6.4 via Duffield'
+
+    elif via_atco == ["109000008733","1000DQCR5878", "1000DKKR5663","1000DWUB5665","1000DCOH5839","1000DHWAR708", "1000DBAR5814","1000DAPA4644"]:
+        departure['display']['via'] = 'Quarndon & Hulland Ward'
+    elif via_atco == ["1090BSTN23", "1000DOOL4017", "1000DBWL4005","1000DBGA4002","1000DBLC3994"]:
+        departure['display']['via'] = 'A38 & Belper Estates'
+    elif via_atco == [ "109000022165", "1090DDAR1606", "1000DLEB4088","1000DCAR1608", "1000DHTS1676","1000DBSB4119","1000DOSL1819","1000DBKR4038" ]:
+        departure['display']['via'] = 'Little Eaton & Holbrook'
+
+    elif via_atco == ["1090BSTN25","43000105509","490008016CS","490016736W", "450032500"]:
+        departure['display']['via'] = 'Birmingham Airport and Heathrow Central'
+    elif via_atco == (["1090BSTN25","3390UN04","3390BB10","269030094","049000000804","02900033","02900065","490008016CS","49001643011","4400CY0375"] or ["1090BSTN25","3390UN04","3390BB10","269030094","049000000804","02900033","02900065","490008016CS","49001643011","4400CY0375"]):
+        departure['display']['via'] = 'Milton Keynes Coachway, Luton Airport & Heathrow Airport'
+    elif via_atco == ["1090BSTN25","1000DCBSB267","370010217","370010201","450027815","450032500" ]:
+        departure['display']['via'] = 'Sheffield & Leeds'
+    elif via_atco ==  [ "1090BSTN25", "269030094","269046004","490000082C","49000144CSZ"] :
+        departure['display']['via'] = 'Finchley Road'
+    elif via_atco == [ "1090BSTN25", "3390UN04", "3390BB10","269030094", "049000000804", "02900033","02900065", "490008016CS","490000104WH"]:
+        departure['display']['via'] = 'Milton Keynes Coachway & Luton Airport'
+
+    #else:
+        #departure['display']['via'] = via_text
+
+
+    if departure['page_service']['slug'] == 'v1-derby-etwall-hilton-hatton-tutbury-rolleston-2' and departure['destination_stop']['atco_code'] in ['3800C302701','3800C303200','3800C303900']:
+        departure['display']['via'] = 'Tutbury'
+    elif departure['page_service']['slug'] == 'v3-derby-littleover-findern-willington-repton-ne-3' and departure['destination_stop']['atco_code'] in ['3800C302700']:
+        departure['display']['via'] = 'Willington'
+    if departure['destination_stop']['atco_code'] in ['49001643011']:
+        departure['display']['destination'] = 'Heathrow Airport, Terminal 5'
+    elif departure['destination_stop']['atco_code'] in ['490016736W']:
+        departure['display']['destination'] = 'London Victoria, Coach Station'
+
+
+
+def rule_case_departures(rules_path):
+    """returns one synthetic departure per case in a rule file"""
+    with open(rules_path, encoding="utf-8") as f:
+        rules = json.loads(f.read())
+
+    cases = []
+    for service in rules.get('services', []):
+        slug = service['slug_contains'] + '-2'
+        cases.append((slug, [], 'none'))
+        cases += [(slug, case['via_atco'], 'none') for case in service.get('via', [])]
+        cases += [(slug, [], atco) for case in service.get('destinations', []) for atco in case['destination_atco']]
+    cases += [('none', rule['via_atco'], 'none') for rule in rules.get('via', [])]
+    cases += [(rule['slug'], [], atco) for rule in rules.get('service_destinations', []) for atco in rule['destination_atco']]
+    cases += [('none', [], atco) for rule in rules.get('destinations', []) for atco in rule['destination_atco']]
+
+    return [{'page_service': {'slug': slug}, 'via_atco': via, 'destination_stop': {'atco_code': destination}}
+            for slug, via, destination in cases]
+
+
+def captured_departure(departure):
+    """returns the fields the rules read from a departure in departures full.json"""
+    return {
+        'page_service': {'slug': departure['service_slug']},
+        'via_atco': departure['via_atco'],
+        'destination_stop': {'atco_code': departure['destination_atco']},
+    }
+
+
+def blank(departure):
+    """returns the fields the rules read from a departure, with empty display and service fields"""
+    return {
+        'page_service': {'slug': departure['page_service']['slug']},
+        'via_atco': list(departure['via_atco']),
+        'destination_stop': {'atco_code': departure['destination_stop']['atco_code']},
+        'display': {'destination': None, 'via': None, 'notes': None},
+        'service': {},
+    }
+
+
+def as_departure(departure):
+    """returns a blank departure as the Departure the rule engine works on"""
+    return Departure(
+        stop=None, bay=None, service_slug=departure['page_service']['slug'], line_name=None,
+        page_destination=None, trip_id=None, trip=None, destination_stop=departure['destination_stop'],
+        scheduled=None, expected=None, scheduled_dt=None, expected_dt=None, circular=False,
+        via_atco=tuple(departure['via_atco']), destination=None,
+    )
+
+
+def outcome(departure):
+    """returns the display and service fields the rules set, from either kind of departure"""
+    if isinstance(departure, Departure):
+        return [departure.destination, departure.via, departure.notes, departure.service_line_name]
+    return [departure['display']['destination'], departure['display']['via'], departure['display']['notes'], departure['service'].get('line_name')]
+
+
+def main():
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('departures', nargs='?', default=os.path.join(here, '_data', 'departures full.json'))
+    parser.add_argument('--rules', default=os.path.join(here, 'config', 'rules.json'))
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    departures = rule_case_departures(args.rules)
+    try:
+        with open(args.departures, encoding="utf-8") as f:
+            departures += [captured_departure(d) for d in json.loads(f.read())]
+    except FileNotFoundError:
+        print("No captured departures at "+args.departures+", using rule cases only")
+    departures = [blank(d) for d in departures]
+
+    engine = DisplayRules.load(args.rules)
+
+    # --- Both must give the same display for every departure ---
+    for d in departures:
+        old, new = copy.deepcopy(d), as_departure(d)
+        legacy_display_rules(old, old['via_atco'])
+        engine.apply(new)
+        if outcome(old) != outcome(new):
+            sys.exit("Mismatch for "+json.dumps(d)+": "+json.dumps(outcome(old))+" != "+json.dumps(outcome(new)))
+
+    batches = [copy.deepcopy(departures), [as_departure(d) for d in departures]]
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        for d in batches[0]:
+            legacy_display_rules(d, d['via_atco'])
+    legacy = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        for d in batches[1]:
+            engine.apply(d)
+    compiled = time.perf_counter() - started
+
+    calls = len(departures) * args.repeat
+    print("%d departures x %d repeats, outputs identical" % (len(departures), args.repeat))
+    print("if/elif chain  %8.3f us per departure" % (legacy / calls * 1e6))
+    print("rule engine    %8.3f us per departure" % (compiled / calls * 1e6))
+    print("speed-up       %8.2fx" % (legacy / compiled))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""load tests /departures/<group> under gunicorn at several worker counts
+
+Usage, from the backend directory:
+    python benchmarks/load_test.py [--workers 1 2 4 8] [--clients 8] [--duration 10]
+
+Each run starts gunicorn with gunicorn.conf.py in a scratch directory, so it
+has its own _data and doesn't fight a running dev server for the refresh lock.
+bustimes.org is replayed from benchmarks/fixtures when they exist (see
+bench_departures.py --record), otherwise it is scraped live. Once the first
+snapshot is built, client processes request the group over keep-alive
+connections for the duration, and requests per second and latency are
+reported per worker count.
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_server(workers, port, scratch, fixtures):
+    """starts gunicorn in a scratch directory, returning the process"""
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), PORT=str(port), LOG_LEVEL='WARNING', PYTHONPATH=here)
+    if fixtures:
+        env['BUSTIMES_REPLAY'] = fixtures
+    return subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(here, 'gunicorn.conf.py'), 'app:app'],
+        cwd=scratch, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_ready(port, path, timeout=120):
+    """polls path until it answers 200, which means the first snapshot has been built"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+            connection.request('GET', path)
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Server on port %d didn't answer %s within %ds" % (port, path, timeout))
+
+
+def hammer(args):
+    """requests path over one keep-alive connection until the deadline, returning latencies and errors"""
+    port, path, deadline = args
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    latencies = []
+    errors = 0
+    while time.time() < deadline:
+        started = time.perf_counter()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors += 1
+                continue
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - started)
+    return latencies, errors
+
+
+def run(workers, args):
+    """load tests one worker count, returning requests per second and latency percentiles"""
+    with tempfile.TemporaryDirectory() as scratch:
+        os.symlink(os.path.join(here, 'config'), os.path.join(scratch, 'config'))
+        server = start_server(workers, args.port, scratch, args.fixtures)
+        try:
+            wait_until_ready(args.port, args.path)
+            deadline = time.time() + args.duration
+            with multiprocessing.Pool(args.clients) as pool:
+                results = pool.map(hammer, [(args.port, args.path, deadline)] * args.clients)
+        finally:
+            server.terminate()
+            server.wait()
+
+    latencies = sorted(l for client_latencies, errors in results for l in client_latencies)
+    errors = sum(errors for client_latencies, errors in results)
+    if not latencies:
+        return {'workers': workers, 'rps': 0.0, 'p50_ms': None, 'p99_ms': None, 'errors': errors}
+    return {
+        'workers': workers,
+        'rps': len(latencies) / args.duration,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client processes')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of load per worker count')
+    parser.add_argument('--group', default='bus_station')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fixtures', default=os.path.join(here, 'benchmarks', 'fixtures'))
+    args = parser.parse_args()
+    args.path = '/departures/' + args.group
+    args.fixtures = os.path.abspath(args.fixtures) if os.path.isdir(args.fixtures) else None
+
+    print("GET %s, %d clients, %gs per run, %s" % (args.path, args.clients, args.duration,
+          'replaying ' + args.fixtures if args.fixtures else 'live from bustimes.org'))
+    print("workers      req/s    p50 ms    p99 ms  errors")
+    for workers in args.workers:
+        result = run(workers, args)
+        print("%7d %10.1f %9s %9s %7d" % (
+            result['workers'], result['rps'],
+            '%.2f' % result['p50_ms'] if result['p50_ms'] is not None else '-',
+            '%.2f' % result['p99_ms'] if result['p99_ms'] is not None else '-',
+            result['errors']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""draws departure boards in a terminal from the background-refreshed snapshots, without the web app
+
+Usage, from the backend directory:
+    python board.py [GROUP ...] [--limit 15] [--plain]
+
+Every group named (cathedral_quarter if none are) is kept fresh by one
+Refresher, so stops shared between boards are scraped once per refresh. On
+a terminal the boards are stacked in fixed blocks of rows and, after each
+refresh, only the lines whose text changed are rewritten. With --plain, or
+when output isn't a terminal, a board is printed in full whenever it changes.
+"""
+import argparse
+import sys
+
+import departures
+from snapshots import Refresher
+
+WIDTH = 128
+HEADER = [
+    "-"*WIDTH,
+    "| STOP | SERVICE |                                                    DESTINATION |  SCH  |  EST  |                   OPERATOR |",
+    "-"*WIDTH,
+]
+LINES_PER_DEPARTURE = 4 # the departure, its via, its notes and a spacer
+
+# --- How long to wait for a refresh before redrawing anyway, e.g. after the first one failed ---
+REDRAW_TIMEOUT = 60
+
+# --- ANSI escapes for drawing boards in place ---
+CLEAR_SCREEN = '\x1b[2J'
+HIDE_CURSOR = '\x1b[?25l'
+SHOW_CURSOR = '\x1b[?25h'
+CLEAR_LINE = '\x1b[K'
+
+
+def move_to(row):
+    """returns the escape moving the cursor to the start of a terminal row, counting from 0"""
+    return '\x1b[%d;1H' % (row + 1)
+
+
+def departure_lines(departure):
+    """returns the table lines for one departure summary, as printDepartures lays them out"""
+    stop = departure['stop']
+    lines = ["| %5s | %6s | %62s | %5s | %5s | %26s | %1s" % (
+        stop['icon'] or stop['indicator'] or stop['bay'], departure['service'], departure['destination'],
+        departure['scheduled'], departure['expected'] or '', departure['operator'], departure['debug'])]
+    if departure['via'] != None:
+        lines.append("| %5s | %6s | %62s | %5s | %5s | %26s |" % ('', '', 'via '+departure['via'], '', '', ''))
+    if departure['notes'] != None:
+        lines.append("| %5s | %6s | %62s | %5s | %5s | %26s |" % ('', '', departure['notes'], '', '', ''))
+    lines.append("| %5s | %6s | %62s | %5s | %5s | %26s |" % ('', '', '', '', '', ''))
+    return lines
+
+
+class Board:
+    """one stop group's board in a fixed block of terminal rows, remembering what each row shows"""
+
+    def __init__(self, name, limit, top=0):
+        self.name = name
+        self.limit = limit
+        self.top = top
+        self.height = 1 + len(HEADER) + limit * LINES_PER_DEPARTURE + 2
+        self.shown = [None] * self.height
+
+    def render(self, snapshot, error=None):
+        """returns the board's lines for a snapshot, padded to its height"""
+        lines = [self.name.replace('_', ' ').upper().center(WIDTH)] + HEADER
+        if snapshot is not None:
+            for departure in snapshot.departures[:self.limit]:
+                lines += departure_lines(departure)
+        lines = lines[:self.height - 2]
+        lines += [''] * (self.height - 2 - len(lines))
+        lines.append("-"*WIDTH)
+
+        if snapshot is None:
+            footer = 'Waiting for departures' + (': ' + error if error else '')
+        elif snapshot.stale:
+            footer = 'Live times are unavailable. Showing departures as of ' + snapshot.refreshed_at.astimezone().strftime('%H:%M')
+        else:
+            footer = 'Data From bustimes.org - Last Updated ' + snapshot.refreshed_at.astimezone().strftime('%Y-%m-%d %X')
+        lines.append('%127s' % footer)
+        return lines
+
+    def draw(self, lines, out):
+        """rewrites just the rows whose text has changed since the last draw, returning how many"""
+        changed = 0
+        for i, line in enumerate(lines):
+            if self.shown[i] != line:
+                out.write(move_to(self.top + i) + line + CLEAR_LINE)
+                self.shown[i] = line
+                changed += 1
+        return changed
+
+    def print(self, lines, out):
+        """prints the whole board, without its padding, if anything on it changed, returning whether it did"""
+        if lines == self.shown:
+            return False
+        out.write('\n'.join(line for line in lines if line) + '\n\n')
+        self.shown = lines
+        return True
+
+
+def run(boards, refresher, out, plain=False):
+    """redraws every board after each refresh until interrupted"""
+    seen = refresher.refreshes
+    while True:
+        for board in boards:
+            group = refresher.groups[board.name]
+            lines = board.render(group.snapshot, group.error)
+            if plain:
+                board.print(lines, out)
+            else:
+                board.draw(lines, out)
+        out.flush()
+        seen = refresher.wait_for_refresh(seen, timeout=REDRAW_TIMEOUT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('groups', nargs='*', default=['cathedral_quarter'], help='stop groups to show, one board each')
+    parser.add_argument('--limit', type=int, default=15, help='departures per board')
+    parser.add_argument('--plain', action='store_true', help='print whole boards as they change instead of redrawing in place')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.groups if name not in departures.stop_groups]
+    if unknown:
+        sys.exit("No stop group called " + ', '.join(unknown))
+
+    refresher = Refresher(departures.get_group_departures, expire=departures.drop_departed)
+    boards = []
+    top = 0
+    for name in dict.fromkeys(args.groups):
+        refresher.add_group(name, departures.stop_groups[name], departures.stop_groups[name]['interval'])
+        boards.append(Board(name, args.limit, top))
+        top += boards[-1].height
+    refresher.start()
+
+    out = sys.stdout
+    plain = args.plain or not out.isatty()
+    if not plain:
+        out.write(CLEAR_SCREEN + HIDE_CURSOR)
+    try:
+        run(boards, refresher, out, plain)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if not plain:
+            out.write(move_to(top) + SHOW_CURSOR)
+            out.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""shared http client for bustimes.org with connection pooling, conditional requests and retries"""
+import collections
+import json
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import fetcher
+
+BASE_URL = 'https://bustimes.org'
+
+headers = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/109.0.0.0 Safari/537.36',
+    'Accept-Encoding': 'gzip, deflate',
+}
+
+# --- Statuses worth another attempt, anything else is returned or raised straight away ---
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class UpstreamError(Exception):
+    """raised when bustimes.org refuses a request, e.g. with a 404, or fails it in any of the ways below"""
+
+
+class UpstreamUnavailable(UpstreamError):
+    """raised when bustimes.org is down rather than refusing one request: retries ran out, or a 5xx"""
+
+
+class CircuitOpen(UpstreamUnavailable):
+    """raised without making a request while bustimes.org is treated as down"""
+
+
+class CircuitBreaker:
+    """stops requests to a failing upstream, letting a single probe through after each cooldown
+
+    Opens after threshold consecutive failed requests, each counted once its
+    retries have run out. Once the cooldown has passed
+    the next request is let through as a probe while the rest keep failing
+    fast: success closes the breaker, failure reopens it for twice as long, up
+    to max_cooldown.
+    """
+
+    def __init__(self, threshold=5, cooldown=15, max_cooldown=300):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.failures = 0
+        self.cooldown = cooldown
+        self.opened_until = 0.0
+        self.trips = 0
+
+    def allow(self):
+        """returns True if a request may be made now"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            now = time.monotonic()
+            if now < self.opened_until:
+                return False
+            # A probe that never reports back doesn't hold the breaker half open for good
+            self.state = 'half_open'
+            self.opened_until = now + self.cooldown
+            return True
+
+    def success(self):
+        """records a request that got an answer, closing the breaker"""
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+
+    def failure(self):
+        """records a request that timed out or was refused, opening the breaker past the threshold"""
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open':
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            elif self.state == 'open' or self.failures < self.threshold:
+                return
+            self.state = 'open'
+            self.opened_until = time.monotonic() + self.cooldown
+            self.trips += 1
+
+    def status(self):
+        """returns the breaker's state and, while open, the seconds until the next probe"""
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'trips': self.trips,
+                'retry_in': round(max(self.opened_until - time.monotonic(), 0.0), 3) if self.state != 'closed' else None,
+            }
+
+
+class BustimesClient:
+    """fetches pages and api records from bustimes.org over a pooled keep-alive session
+
+    The ETag/Last-Modified of each stop record are remembered, not its body.
+    A caller refetching a stop it already holds passes it in, and the
+    validators are sent along so a 304 hands that record straight back. Requests go
+    through a circuit breaker, so while bustimes.org is down they fail at once
+    instead of each waiting out the timeout.
+    """
+
+    def __init__(self, timeout=10, retries=3, backoff=0.5, max_validators=5000, breaker=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_validators = max_validators
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=fetcher.PER_HOST_LIMIT)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._validators = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = collections.defaultdict(lambda: {'requests': 0, 'errors': 0, 'retries': 0, 'not_modified': 0, 'short_circuited': 0, 'seconds': 0.0})
+        self.statuses = collections.Counter()
+
+    # --- Endpoints ---
+
+    def stop_page(self, atco_code):
+        """returns the departures page html for a stop"""
+        return self.get('stop_page', '/stops/'+str(atco_code)+'/')
+
+    def station_page(self, code):
+        """returns the departures page html for a station"""
+        return self.get('station_page', '/stations/'+str(code)+'/')
+
+    def trip(self, trip_id):
+        """returns the api record for a trip
+
+        Not fetched conditionally: trips are cached until they have run and
+        never fetched again, so there is no copy to revalidate.
+        """
+        return json.loads(self.get('trip', '/api/trips/'+str(trip_id)+'/?format=json'))
+
+    def stop(self, atco_code, cached=None):
+        """returns the api metadata for a stop, or cached if bustimes.org says it hasn't changed"""
+        return self.get_record('stop', '/api/stops/'+str(atco_code)+'/?format=json', cached)
+
+    # --- Transport ---
+
+    def get_record(self, endpoint, path, cached=None):
+        """fetches an api record, conditionally when the caller holds a copy, which a 304 returns"""
+        text = self.get(endpoint, path, conditional=True, have_copy=cached is not None)
+        return cached if text is None else json.loads(text)
+
+    def get(self, endpoint, path, conditional=False, have_copy=False):
+        """fetches a path, retrying transient failures with jittered exponential backoff
+
+        conditional remembers the response's validators. have_copy sends them,
+        returning None if bustimes.org answers 304.
+        """
+        url = BASE_URL + path
+        request_headers = {}
+        validators = None
+        if conditional and have_copy:
+            with self._lock:
+                validators = self._validators.get(url)
+            if validators is not None:
+                etag, last_modified = validators
+                if etag:
+                    request_headers['If-None-Match'] = etag
+                if last_modified:
+                    request_headers['If-Modified-Since'] = last_modified
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count(endpoint, 'retries')
+                time.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+
+            if not self.breaker.allow():
+                self._count(endpoint, 'short_circuited')
+                if attempt:
+                    self.breaker.failure()
+                raise CircuitOpen(f"{url} not requested, bustimes.org is failing")
+
+            started = time.perf_counter()
+            self._count(endpoint, 'requests')
+            try:
+                with fetcher.host_limit(url):
+                    response = self.session.get(url, headers=request_headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._count(endpoint, 'errors')
+                self._count_status(endpoint, type(e).__name__)
+                error = e
+                continue
+            finally:
+                self._count(endpoint, 'seconds', time.perf_counter() - started)
+            self._count_status(endpoint, response.status_code)
+
+            if response.status_code in RETRY_STATUSES:
+                self._count(endpoint, 'errors')
+                error = UpstreamUnavailable(f"{url} returned {response.status_code}")
+                continue
+            self.breaker.success()
+
+            if response.status_code == 304 and validators is not None:
+                self._count(endpoint, 'not_modified')
+                self._remember(url, validators)
+                return None
+            if response.status_code >= 400:
+                self._count(endpoint, 'errors')
+                raise (UpstreamUnavailable if response.status_code >= 500 else UpstreamError)(f"{url} returned {response.status_code}")
+
+            if conditional and (response.headers.get('ETag') or response.headers.get('Last-Modified')):
+                self._remember(url, (response.headers.get('ETag'), response.headers.get('Last-Modified')))
+            return response.text
+
+        # --- One failure per request whose retries ran out, however many attempts it took ---
+        self.breaker.failure()
+        raise UpstreamUnavailable(f"{url} failed after {self.retries + 1} attempts: {error}")
+
+    def _count(self, endpoint, key, amount=1):
+        """adds to one of an endpoint's counters"""
+        with self._lock:
+            self.stats[endpoint][key] += amount
+
+    def _count_status(self, endpoint, status):
+        """counts a response status, or the exception name for a request that got none"""
+        with self._lock:
+            self.statuses[(endpoint, str(status))] += 1
+
+    def _remember(self, url, validator):
+        """stores the validators for a url, dropping the least recently used past the cap"""
+        with self._lock:
+            self._validators[url] = validator
+            self._validators.move_to_end(url)
+            while len(self._validators) > self.max_validators:
+                self._validators.popitem(last=False)
+
+    def counters(self):
+        """returns a copy of the per-endpoint latency, error and response status counters"""
+        with self._lock:
+            out = {endpoint: dict(stats, statuses={}) for endpoint, stats in self.stats.items()}
+            for (endpoint, status), n in self.statuses.items():
+                out[endpoint]['statuses'][status] = n
+            return out
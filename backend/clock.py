@@ -0,0 +1,64 @@
+"""one reference instant per refresh, placing the bare HH:MM times bustimes.org gives on their dates"""
+import datetime
+
+# --- How long before its reference instant a time of day can be and still be placed on the earlier date ---
+PAGE_LOOKBACK = datetime.timedelta(hours=1)  # stop pages list upcoming buses, only in the past when running late
+TRIP_LOOKBACK = datetime.timedelta(hours=12) # a trip's calls either side of the departure, on a long overnight journey too
+
+
+class RefreshClock:
+    """the instant a refresh started, turning times of day into local datetimes around it
+
+    Stop pages and trips give times without a date. A time is placed on the
+    day before, the day of or the day after a reference instant, whichever
+    is the first no longer than the lookback before it. Page times are placed
+    around the refresh's instant, so buses running late, even from before
+    midnight, stay on their own day while tomorrow's first buses listed late
+    in the evening move to tomorrow. Trip times are placed around the
+    departure's scheduled time, so a trip's calls land on the dates either
+    side of midnight that the departure's own does. The date is combined with
+    the wall time before localising, so a time on the far side of a clock
+    change gets that day's UTC offset. Conversions are cached by value, as a
+    refresh sees the same few hundred times over and over.
+    """
+
+    __slots__ = ('now', '_pages', '_trips')
+
+    def __init__(self, now=None):
+        self.now = now if now is not None else datetime.datetime.now().astimezone()
+        self._pages = {}
+        self._trips = {}
+
+    @staticmethod
+    def _place(time, reference, lookback):
+        """returns a datetime.time as a local datetime on the first of the days around reference no more than lookback before it"""
+        cutoff = reference - lookback
+        day = reference.date()
+        for offset in (-1, 0, 1):
+            dt = datetime.datetime.combine(day + datetime.timedelta(days=offset), time).astimezone()
+            if dt > cutoff:
+                break
+        return dt
+
+    def page_time(self, text):
+        """returns an HH:MM string from a stop page as a local datetime
+
+        Raises TypeError or ValueError if text isn't a time, as strptime does.
+        """
+        try:
+            return self._pages[text]
+        except (KeyError, TypeError):
+            pass
+        dt = self._place(datetime.datetime.strptime(text, '%H:%M').time(), self.now, PAGE_LOOKBACK)
+        self._pages[text] = dt
+        return dt
+
+    def trip_time(self, time, reference=None):
+        """returns a trip's aimed datetime.time as a local datetime around reference, the departure's scheduled datetime, or now"""
+        reference = reference if reference is not None else self.now
+        try:
+            return self._trips[time, reference]
+        except KeyError:
+            pass
+        dt = self._trips[time, reference] = self._place(time, reference, TRIP_LOOKBACK)
+        return dt
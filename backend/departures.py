@@ -0,0 +1,396 @@
+"""scrapes bus departures for stop groups from bustimes.org"""
+import datetime
+import email.utils
+import json
+import logging
+import fetcher
+import metrics
+import replay
+from bustimes import BustimesClient, UpstreamUnavailable
+from stopstore import StopStore
+from tripcache import TripCache
+from pageparser import parse_departures
+from models import Stop, Departure
+from clock import RefreshClock
+from stopplanner import StopPlanner
+from rules import DisplayRules
+from persistence import SnapshotWriter
+
+RULES_PATH = 'config/rules.json'
+GROUPS_PATH = 'config/groups.json'
+FULL_PATH = '_data/departures full.json'
+SUMMARY_PATH = '_data/departures sumary.json'
+
+log = logging.getLogger(__name__)
+
+def nowUTC():
+    """returns current UTC time as timezone aware datetime"""
+    return datetime.datetime.now(datetime.UTC)
+
+def nowLocal():
+    """returns current local time as timezone aware datetime"""
+    return datetime.datetime.now().astimezone()
+
+def load_stop_groups(path = GROUPS_PATH):
+    """loads stop groups from a config file
+
+    Filter values naming one of the file's stop_lists are swapped for that list,
+    and groups listing their own rule files get those compiled ahead of the
+    shared rules.
+    """
+    with open(path, encoding="utf-8") as f:
+        config = json.loads(f.read())
+
+    stop_lists = config.get('stop_lists', {})
+    groups = config['groups']
+    for group in groups.values():
+        for extras in group['stops'].values():
+            stop_filter = extras.get('filter')
+            if stop_filter and isinstance(stop_filter.get('value'), str):
+                stop_filter['value'] = stop_lists[stop_filter['value']]
+            if stop_filter:
+                stop_filter['value'] = frozenset(stop_filter['value'])
+        group.setdefault('interval', 60)
+        group['display_rules'] = DisplayRules.load(*group['rules'], RULES_PATH) if group.get('rules') else None
+    return groups
+
+# --- Shared bustimes.org client, pooled across every request the app makes ---
+client = BustimesClient()
+replay.install_from_env(client) # BUSTIMES_RECORD/BUSTIMES_REPLAY to capture or serve offline fixtures
+
+# --- Stop metadata, read from the local store as needed (bulk-loaded by load_stops.py) and written back only as entries change ---
+stops_data = StopStore()
+
+# --- Journeys, kept until they have run and persisted as they are fetched ---
+trips_data = TripCache()
+
+# --- Destination/via overrides, compiled from the rule file once at start ---
+display_rules = DisplayRules.load(RULES_PATH)
+
+# --- Departures built from each stop's page last time, and when each page is next worth fetching ---
+stop_planner = StopPlanner()
+
+# --- Departures full/summary dumps, written off the refresh path ---
+snapshot_writer = SnapshotWriter()
+
+# --- Stop groups shown on the boards ---
+stop_groups = load_stop_groups()
+
+def destination_filtered(stop_filter, destination_atco):
+    """returns True if a stop's filter hides departures to the given destination stop"""
+    if not stop_filter:
+        return False
+    if stop_filter['key'] == 'destination_stop/atco_code' and stop_filter['type'] == 'is_not':
+        return destination_atco in stop_filter['value']
+    return False
+
+def prefetch_trips_and_stops(rows, stops, stops_data, trips_data):
+    """fetches every trip and stop the departure rows will need, one concurrent batch per level
+
+    Anything that fails to fetch here is left out of the caches, so the row
+    loop falls back to fetching it itself and skips the row if that fails too.
+    """
+    trip_ids = {stop: [row.trip_id for row in stop_rows] for stop,stop_rows in rows.items()}
+
+    # --- Trips not already cached ---
+    missing_trips = [t for ids in trip_ids.values() for t in ids if trips_data.get(t) is None]
+    if missing_trips:
+        log.info("getting trip data for %d trips", len(set(missing_trips)))
+        metrics.count('trips_fetched', len(set(missing_trips)))
+        with metrics.span('trip_fetch'):
+            results = fetcher.fan_out(client.trip, missing_trips)
+        for trip_id in missing_trips:
+            result = results[trip_id]
+            if not isinstance(result, Exception):
+                trips_data[trip_id] = result
+
+    # --- Destinations, and timing points of trips that won't be filtered out ---
+    missing_stops = []
+    for stop,ids in trip_ids.items():
+        stop_filters = stops[stop].filters
+        for trip_id in ids:
+            try:
+                timing = trips_data.timing(trip_id)
+            except KeyError:
+                continue
+            destination_id = timing.destination_atco
+            if destination_id is None:
+                continue
+            missing_stops.append(destination_id)
+            if all(destination_filtered(f, destination_id) for f in stop_filters):
+                continue
+            missing_stops += [atco_code for atco_code, aimed in timing.timing_points]
+    missing_stops = [s for s in dict.fromkeys(missing_stops) if stops_data.get(s) is None]
+    if missing_stops:
+        log.info("getting stop metadata for %d stops", len(missing_stops))
+        metrics.count('stops_fetched', len(missing_stops))
+        with metrics.span('stop_fetch'):
+            results = fetcher.fan_out(client.stop, missing_stops)
+        for atco_code in missing_stops:
+            result = results[atco_code]
+            if not isinstance(result, Exception):
+                stops_data[atco_code] = result
+
+def plan_stops(groups):
+    """merges the stops of several groups into one request, listing each stop once with every group's filter"""
+    plan = {}
+    for group in groups.values():
+        for stop,extras in group['stops'].items():
+            planned = plan.setdefault(stop, {'type': extras.get('type'), 'filters': []})
+            planned['filters'].append(extras.get('filter'))
+    return plan
+
+def refetch_stop(atco_code):
+    """fetches a stop's api metadata, conditionally when a copy is already stored"""
+    return client.stop(atco_code, stops_data.get(atco_code))
+
+def get_stop_departures(stops_request, clock=None):
+    """gets bus departures from each stop in a planned request, returning them by stop
+
+    Only stops the planner says are due have their pages fetched, the rest
+    reuse the departures built from their pages last time. Page times are
+    placed relative to the one instant of clock, a new RefreshClock if none is
+    given, and each trip's times relative to its departure's scheduled time.
+
+    A stop whose page can't be fetched, or whose rows need a trip or stop
+    while bustimes.org is down, maps to that error instead of its departures,
+    rather than being built missing rows, so only the groups showing it go
+    stale. A trip or stop bustimes.org refuses, e.g. with a 404, only loses
+    that row.
+    """
+    if clock is None:
+        clock = RefreshClock()
+    refresh_time = clock.now
+    due = {stop: extras for stop,extras in stops_request.items() if stop_planner.due(stop, extras['filters'], refresh_time)}
+
+    # --- Fetches departure pages and any missing stop metadata concurrently ---
+    page_jobs = {}
+    metadata_jobs = {}
+    for stop,extras in due.items():
+        if extras.get('type') == 'station':    # if the stop is actually a station
+            page_jobs[stop] = (client.station_page, stop)
+        else:
+            if stops_data.get(stop) == None or stops_data.get(stop).get('long_name') == None:
+                metadata_jobs[stop] = (refetch_stop, stop)
+            page_jobs[stop] = (client.stop_page, stop)
+
+    log.info("getting departures and metadata for %d of %d stops", len(page_jobs), len(stops_request))
+    metrics.count('pages_fetched', len(page_jobs))
+    metrics.count('pages_skipped', len(stops_request) - len(page_jobs))
+    with metrics.span('stop_page_fetch'):
+        pages = fetcher.fan_out(fetcher.call, list(page_jobs.values()) + list(metadata_jobs.values()))
+
+    stops = {}
+    html = {}
+    errors = {} # stops that couldn't be built at all, by the error that stopped them
+    for stop,extras in due.items():
+        try:
+            if stop in metadata_jobs:
+                stops_data[stop] = fetcher.unwrap(pages[metadata_jobs[stop]])
+            info = {} if extras.get('type') == 'station' else stops_data[stop]
+            html[stop] = fetcher.unwrap(pages[page_jobs[stop]])
+        except Exception as e:
+            log.warning("Could not get the departures page for stop %s: %s", stop, e)
+            errors[stop] = e
+            continue
+        stops[stop] = Stop(code=stop, type=extras.get('type'), info=info, filters=extras['filters'])
+
+    with metrics.span('parse'):
+        rows = {stop: parse_departures(page) for stop,page in html.items()}
+    prefetch_trips_and_stops(rows, stops, stops_data, trips_data)
+
+    departures_by_stop = {}
+    failed = set() # stops with rows that couldn't be built, fetched again next refresh rather than reused
+
+    for stop,stop_info in stops.items():
+        log.debug('parcing departures for %s %s', stop, stop_info.long_name or '(Stop Name Not Found)')
+        departures_by_stop[stop] = []
+        try:
+            for row in rows[stop]:
+                try:
+                    try:
+                        trip =  trips_data[row.trip_id]
+                    except KeyError:
+                        log.info("getting trip data for %s", row.trip_id)
+                        trips_data[row.trip_id] = client.trip(row.trip_id)
+                        trip = trips_data[row.trip_id]
+
+                    timing = trips_data.timing(row.trip_id)
+                    destination_id = timing.destination_atco
+
+                    try:
+                        destination_stop =  stops_data[destination_id]
+                    except KeyError:
+                        log.info("getting stop metadata for %s", destination_id)
+                        destination_stop = client.stop(destination_id)
+                        stops_data[destination_id] = destination_stop
+
+                    #Destination Filter
+                    #    Rows are only dropped here if every group showing this stop filters them out
+                    if all(destination_filtered(f, destination_id) for f in stop_info.filters):
+                        continue
+
+                    scheduled_dt = clock.page_time(row.scheduled)
+                    try:
+                        expected_dt = clock.page_time(row.expected)
+                    except (TypeError, ValueError):
+                        # If expected time is missing or invalid, default to scheduled time (already correctly dated)
+                        expected_dt = scheduled_dt
+
+                    with metrics.span('via'):
+                        timing_points_data = {}
+
+                        for atco_code, aimed in timing.timing_points:
+                            try:
+                                timing_points_data[atco_code] = stops_data[atco_code]
+                            except KeyError:
+                                log.info("getting stop metadata for %s", atco_code)
+                                stops_data[atco_code] = client.stop(atco_code)
+                                timing_points_data[atco_code] = stops_data[atco_code]
+
+                        via_calc = []
+
+                        for atco_code, aimed in timing.timing_points:
+                            tp_info = timing_points_data[atco_code]
+                            aimed_dt = clock.trip_time(aimed, scheduled_dt)
+                            try:
+                                if aimed_dt >= scheduled_dt:
+                                    via_calc.append({'atco_code':tp_info['atco_code'],'common_name':tp_info['common_name'],'name':tp_info['name'],'time_dt':aimed_dt})
+                            except KeyError:
+                                pass
+
+                        via_calc = sorted(via_calc, key=lambda x: (x['time_dt']))
+                        via_calc = via_calc[:-1]
+
+                    departure = Departure(
+                        stop=stop_info,
+                        bay=row.bay,
+                        service_slug=row.service_slug,
+                        line_name=row.line_name,
+                        page_destination=row.destination,
+                        trip_id=row.trip_id,
+                        trip=trip,
+                        destination_stop=destination_stop,
+                        scheduled=row.scheduled,
+                        expected=row.expected,
+                        scheduled_dt=scheduled_dt,
+                        expected_dt=expected_dt,
+                        circular=timing.circular,
+                        via_atco=tuple(i['atco_code'] for i in via_calc),
+                        destination=destination_stop['name'].replace(' '+destination_stop['common_name'],', '+destination_stop['common_name']).replace(' Town Ctr',''),
+                    )
+
+                    departure.keep_page_display()
+                    with metrics.span('rules'):
+                        display_rules.apply(departure)
+
+                    departures_by_stop[stop].append(departure)
+
+                except UpstreamUnavailable:
+                    # bustimes.org being down fails the whole stop, so the last good snapshot of each group
+                    #     showing it is served stale rather than replaced by one missing these rows
+                    raise
+                except Exception as e: # <--- NEW INNER EXCEPT BLOCK
+                    log.exception("Error processing departure row for stop %s: %s", stop, e) # <--- Log the full traceback for this row
+                    failed.add(stop)
+                    continue
+        except UpstreamUnavailable as e:
+            log.warning("Could not get departures for stop %s: %s", stop, e)
+            errors[stop] = e
+        except Exception as e: # <--- REPLACE YOUR 'except AttributeError:' with this.
+            log.exception("General scraping error for stop %s: %s", stop, e) # <--- THIS IS THE NEW IMPORTANT LINE
+            failed.add(stop)
+
+    # --- Merges the stops just scraped with the ones reused, in the order they were asked for ---
+    #     A stop missing rows, or not built at all, is left due, so it's fetched again next refresh
+    for stop,extras in due.items():
+        if stop in failed or stop in errors:
+            stop_planner.forget(stop)
+        else:
+            stop_planner.update(stop, extras['filters'], departures_by_stop[stop], refresh_time)
+    return {stop: errors[stop] if stop in errors else departures_by_stop[stop] if stop in due else stop_planner.departures(stop)
+            for stop in stops_request}
+
+def summarise_departures(departures_full_data, now=None):
+    """returns the api summary of departures, soonest first, dropping any more than 5 minutes before now"""
+    departures_summary = [d.to_summary() for d in departures_full_data]
+
+    departures_summary = sorted(drop_departed(departures_summary, now or nowLocal()), key=lambda x: (x['expected_dt']))
+
+    return departures_summary
+
+def drop_departed(departures_summary, current_time):
+    """returns the summary departures not expected more than 5 minutes before current_time
+
+    This removes buses that have already departed or are severely delayed past
+    relevance. It is also run over the last good snapshot when it is served
+    stale, so buses keep dropping off the board while bustimes.org is down.
+    Summaries read back from the shared snapshot store carry their times as
+    the http dates they were serialised to.
+    """
+    cutoff = current_time - datetime.timedelta(minutes=5)
+    return [departure for departure in departures_summary if departure_time(departure['expected_dt']) >= cutoff]
+
+def departure_time(value):
+    """returns a summary time as a datetime, parsing it if it's an http date"""
+    if isinstance(value, str):
+        return email.utils.parsedate_to_datetime(value)
+    return value
+
+def with_group_rules(departure, rules):
+    """returns a copy of a departure with a group's own display rules applied instead of the shared ones"""
+    departure = departure.with_page_display()
+    rules.apply(departure)
+    return departure
+
+def get_group_departures(groups):
+    """gets departures for several stop groups, scraping each stop they share only once
+
+    groups maps a group name to its config, as loaded by load_stop_groups.
+    Returns a dict of group name to departures summary, or to the error that
+    stopped one of the group's stops being built, as fan_out does.
+    """
+    with metrics.trace(', '.join(groups)):
+        clock = RefreshClock()
+        departures_by_stop = get_stop_departures(plan_stops(groups), clock)
+
+        summaries = {}
+        for name,group in groups.items():
+            failures = [departures_by_stop[stop] for stop in group['stops'] if isinstance(departures_by_stop.get(stop), Exception)]
+            if failures:
+                summaries[name] = failures[0]
+                continue
+            group_departures = []
+            for stop,extras in group['stops'].items():
+                for departure in departures_by_stop.get(stop, []):
+                    if destination_filtered(extras.get('filter'), departure.destination_atco):
+                        continue
+                    if group.get('display_rules') is not None:
+                        with metrics.span('rules'):
+                            departure = with_group_rules(departure, group['display_rules'])
+                    group_departures.append(departure)
+            with metrics.span('sort_filter'):
+                summaries[name] = summarise_departures(group_departures, clock.now)
+            metrics.count('departures', len(summaries[name]))
+
+        with metrics.span('persist'):
+            departures_full_data = [d.to_debug() for stop_departures in departures_by_stop.values()
+                                    if not isinstance(stop_departures, Exception) for d in stop_departures]
+            snapshot_writer.submit(FULL_PATH, departures_full_data)
+            snapshot_writer.submit(SUMMARY_PATH, {name: summary for name, summary in summaries.items() if not isinstance(summary, Exception)}, sort_keys=True)
+
+            stops_data.flush()
+
+            trips_data.evict()
+            trips_data.flush()
+
+    return summaries
+
+def get_departures(stops_request = None):
+    """gets bus departures from specified stops"""
+
+    # --- Sets default stops for function if none are specified ---
+    if stops_request is None:
+        stops_request = stop_groups['cathedral_quarter']['stops']
+
+    return fetcher.unwrap(get_group_departures({'departures': {'stops': stops_request}})['departures'])
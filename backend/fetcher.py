@@ -0,0 +1,49 @@
+"""concurrent fan-out of upstream requests with a per-host concurrency limit"""
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_WORKERS = 16
+PER_HOST_LIMIT = 6
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='fetcher')
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+
+
+def host_limit(url):
+    """returns the semaphore bounding concurrent requests to url's host"""
+    host = urllib.parse.urlsplit(url).netloc
+    with _host_limits_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(PER_HOST_LIMIT)
+        return _host_limits[host]
+
+
+def fan_out(fn, items):
+    """calls fn on every item concurrently
+
+    Returns a dict of item to result. Items whose call raised map to the
+    exception instead, so one failure doesn't lose the rest of the batch.
+    """
+    items = list(dict.fromkeys(items))
+    futures = {item: _executor.submit(fn, item) for item in items}
+    results = {}
+    for item, future in futures.items():
+        try:
+            results[item] = future.result()
+        except Exception as e:
+            results[item] = e
+    return results
+
+
+def unwrap(result):
+    """returns a fan_out result, re-raising it if the call failed"""
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def call(job):
+    """calls a (function, *args) tuple, for fanning out a mix of calls in one batch"""
+    return job[0](*job[1:])
@@ -0,0 +1,23 @@
+"""gunicorn settings for serving the departures api from several worker processes
+
+Run from the backend directory:
+    gunicorn -c gunicorn.conf.py app:app
+
+The first worker to get a request takes the refresh lock and does all the
+scraping, publishing snapshots to _data/snapshots.db. The other workers serve
+those snapshots, and one of them takes over if that worker dies.
+"""
+import multiprocessing
+import os
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count(), 4)))
+
+# --- Threads so a worker holding departure streams open can still answer polls ---
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 8))
+
+# --- The app isn't preloaded: each worker opens its own sqlite connections and threads after the fork ---
+preload_app = False
+keepalive = 5
+accesslog = os.environ.get('ACCESS_LOG') # e.g. '-' for stdout, off by default
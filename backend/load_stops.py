@@ -0,0 +1,164 @@
+"""bulk-loads stop metadata into the local stop store, so boards start without fetching stops one at a time
+
+Usage, from the backend directory:
+    python load_stops.py naptan Stops.csv [--area 109 100 ...] [--replace]
+    python load_stops.py api [ATCO ...] [--boards] [--trips] [--replace]
+    python load_stops.py find NAME [--limit 20]
+
+naptan reads the stops CSV from a NaPTAN download (naptan.api.dft.gov.uk),
+keeping only atco codes starting with one of the --area prefixes if any are
+given, and stores each stop in the shape bustimes.org's api returns it. Stops
+already fetched from bustimes.org are left alone unless --replace is given.
+
+api fetches stops from bustimes.org concurrently: the atco codes given, every
+stop on the boards (--boards) and every timing point of the cached trips
+(--trips). Only stops not already stored are fetched unless --replace is given.
+
+find lists stored stops whose name or common name starts with NAME.
+"""
+import argparse
+import csv
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+os.chdir(here)
+
+import departures
+import fetcher
+from stopstore import SOURCE_API, SOURCE_NAPTAN
+
+# --- NaPTAN indicators bustimes.org spells out in front of the common name rather than bracketing ---
+INDICATOR_PREFIXES = {'opp': 'opposite', 'adj': 'adjacent to', 'outside': 'outside', 'o/s': 'outside', 'at': 'at', 'before': 'before'}
+
+# --- Indicators naming a stop letter or number, which bustimes.org shows as the stop's icon ---
+ICON_WORDS = ('stop', 'bay', 'stand', 'stance', 'gate', 'platform')
+
+
+def stop_icon(indicator):
+    """returns the short stop letter or number in an indicator like 'Stop B2' or 'Bay 20', or None"""
+    parts = indicator.split()
+    if len(parts) == 2 and parts[0].lower() in ICON_WORDS and len(parts[1]) <= 2:
+        return parts[1]
+    if 0 < len(indicator) <= 2 and not indicator.islower():
+        return indicator
+    return None
+
+
+def naptan_stop(row):
+    """returns a NaPTAN csv row as a bustimes.org api stop record
+
+    The name is the common name behind its locality, unless the common name
+    already includes it, and the long name adds the indicator as bustimes.org
+    does.
+    """
+    common_name = row['CommonName'].strip()
+    locality = row.get('LocalityName', '').strip()
+    indicator = row.get('Indicator', '').strip()
+    name = common_name if not locality or locality in common_name else locality + ' ' + common_name
+
+    if indicator.lower() in INDICATOR_PREFIXES and locality and locality not in common_name:
+        long_name = locality + ', ' + INDICATOR_PREFIXES[indicator.lower()] + ' ' + common_name
+    elif indicator:
+        long_name = name + ' (' + indicator + ')'
+    else:
+        long_name = name
+
+    try:
+        location = [float(row['Longitude']), float(row['Latitude'])]
+    except (KeyError, ValueError):
+        location = None
+
+    return {
+        'atco_code': row['ATCOCode'].strip(),
+        'naptan_code': row.get('NaptanCode', '').strip() or None,
+        'common_name': common_name,
+        'name': name,
+        'long_name': long_name,
+        'location': location,
+        'indicator': indicator,
+        'icon': stop_icon(indicator),
+        'bearing': row.get('Bearing', '').strip(),
+        'heading': None,
+        'stop_type': row.get('StopType', '').strip() or None,
+        'bus_stop_type': row.get('BusStopType', '').strip(),
+        'created_at': row.get('CreationDateTime') or None,
+        'modified_at': row.get('ModificationDateTime') or None,
+        'active': row.get('Status', 'active').strip().lower() in ('active', 'act'),
+    }
+
+
+def read_naptan(path, areas=()):
+    """yields the stops in a NaPTAN stops csv, only those whose atco code starts with one of areas if given"""
+    areas = tuple(areas)
+    with open(path, encoding='utf-8-sig', errors='replace', newline='') as f:
+        for row in csv.DictReader(f):
+            if not row.get('ATCOCode') or not row.get('CommonName'):
+                continue
+            if areas and not row['ATCOCode'].startswith(areas):
+                continue
+            yield naptan_stop(row)
+
+
+def api_codes(args):
+    """returns the atco codes the api command was asked to fetch"""
+    codes = list(args.atco_codes)
+    if args.boards:
+        codes += [stop for group in departures.stop_groups.values()
+                  for stop, extras in group['stops'].items() if extras.get('type') != 'station']
+    if args.trips:
+        for trip_id in departures.trips_data:
+            timing = departures.trips_data.timing(trip_id)
+            codes += [atco_code for atco_code, aimed in timing.timing_points]
+            if timing.destination_atco is not None:
+                codes.append(timing.destination_atco)
+    codes = list(dict.fromkeys(codes))
+    if not args.replace:
+        codes = [atco_code for atco_code in codes if atco_code not in departures.stops_data]
+    return codes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    naptan = commands.add_parser('naptan', help='load stops from a NaPTAN stops csv')
+    naptan.add_argument('path')
+    naptan.add_argument('--area', nargs='+', default=[], help='atco code prefixes to keep')
+    naptan.add_argument('--replace', action='store_true', help='replace stops fetched from bustimes.org too')
+
+    api = commands.add_parser('api', help='fetch stops from bustimes.org')
+    api.add_argument('atco_codes', nargs='*')
+    api.add_argument('--boards', action='store_true', help='every stop on the boards')
+    api.add_argument('--trips', action='store_true', help='every timing point of the cached trips')
+    api.add_argument('--replace', action='store_true', help='fetch stops that are already stored too')
+
+    find = commands.add_parser('find', help='look up stored stops by name')
+    find.add_argument('name')
+    find.add_argument('--limit', type=int, default=20)
+
+    args = parser.parse_args()
+    stops_data = departures.stops_data
+
+    if args.command == 'naptan':
+        written = stops_data.load(read_naptan(args.path, args.area), source=SOURCE_NAPTAN, replace=args.replace)
+        print("Loaded %d stops from %s into %s" % (written, args.path, stops_data.path))
+
+    elif args.command == 'api':
+        codes = api_codes(args)
+        results = fetcher.fan_out(lambda atco_code: departures.client.stop(atco_code, stops_data.get(atco_code)), codes)
+        fetched = [result for result in results.values() if not isinstance(result, Exception)]
+        written = stops_data.load(fetched, source=SOURCE_API, replace=True)
+        print("Fetched %d of %d stops from bustimes.org into %s" % (written, len(codes), stops_data.path))
+        for atco_code, result in results.items():
+            if isinstance(result, Exception):
+                print("    %s: %s" % (atco_code, result))
+
+    elif args.command == 'find':
+        for stop in stops_data.find(args.name, args.limit):
+            print("%-14s %s" % (stop['atco_code'], stop.get('long_name') or stop.get('name')))
+
+
+if __name__ == '__main__':
+    main()
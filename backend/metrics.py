@@ -0,0 +1,158 @@
+"""timing spans for each stage of a refresh, and prometheus text output of the app's counters"""
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Trace:
+    """where one refresh spent its time, by stage, plus anything it counted along the way"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started_at = datetime.datetime.now(datetime.UTC)
+        self.duration = None
+        self.error = None
+        self.stages = {}
+        self.counts = {}
+
+    def add(self, stage, seconds):
+        """adds a timed call to a stage"""
+        totals = self.stages.setdefault(stage, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += 1
+
+    def count(self, key, amount=1):
+        """adds to one of the refresh's counts"""
+        self.counts[key] = self.counts.get(key, 0) + amount
+
+    def as_dict(self):
+        """returns the trace as a json-ready dict"""
+        return {
+            'name': self.name,
+            'started_at': self.started_at.isoformat(),
+            'duration': round(self.duration, 6) if self.duration is not None else None,
+            'error': self.error,
+            'stages': {stage: {'seconds': round(seconds, 6), 'calls': calls} for stage, (seconds, calls) in self.stages.items()},
+            'counts': dict(self.counts),
+        }
+
+
+class Recorder:
+    """running totals over every finished trace, optionally logging each one as a json line"""
+
+    def __init__(self, log_path=None):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self.stage_seconds = {}
+        self.stage_calls = {}
+        self.counts = {}
+        self.refreshes = 0
+        self.errors = 0
+        self.refresh_seconds = 0.0
+        self.last = None
+
+    def record(self, trace):
+        """adds a finished trace to the totals and appends it to the trace log"""
+        with self._lock:
+            self.refreshes += 1
+            self.errors += trace.error is not None
+            self.refresh_seconds += trace.duration
+            for stage, (seconds, calls) in trace.stages.items():
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+                self.stage_calls[stage] = self.stage_calls.get(stage, 0) + calls
+            for key, amount in trace.counts.items():
+                self.counts[key] = self.counts.get(key, 0) + amount
+            self.last = trace
+
+        if self.log_path:
+            try:
+                os.makedirs(os.path.dirname(self.log_path) or '.', exist_ok=True)
+                with open(self.log_path, 'a', encoding="utf-8") as f:
+                    f.write(json.dumps(trace.as_dict()) + '\n')
+            except OSError as e:
+                log.warning("Could not write refresh trace to %s: %s", self.log_path, e)
+
+
+# --- The trace of the refresh running on this thread, if any ---
+_current = contextvars.ContextVar('trace', default=None)
+
+recorder = Recorder()
+
+
+@contextlib.contextmanager
+def trace(name):
+    """times a whole refresh, collecting the spans and counts made inside it"""
+    current = Trace(name)
+    token = _current.set(current)
+    started = time.perf_counter()
+    try:
+        yield current
+    except Exception as e:
+        current.error = str(e)
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        _current.reset(token)
+        recorder.record(current)
+        log.debug("Refreshed %s in %.3fs: %s", name, current.duration, current.stages)
+
+
+@contextlib.contextmanager
+def span(stage):
+    """times a stage of the refresh running on this thread; does nothing outside a trace"""
+    current = _current.get()
+    if current is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.add(stage, time.perf_counter() - started)
+
+
+def count(key, amount=1):
+    """adds to a count on the refresh running on this thread"""
+    current = _current.get()
+    if current is not None:
+        current.count(key, amount)
+
+
+# --- Prometheus text exposition ---
+
+def label_text(labels):
+    """formats a dict of labels as {a="1",b="2"}"""
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in labels.values())
+    return '{' + ','.join(k + '="' + v + '"' for k, v in zip(labels, escaped)) + '}'
+
+
+def render(families):
+    """returns prometheus text for (name, type, help, [(labels, value), ...]) metric families"""
+    lines = []
+    for name, kind, description, samples in families:
+        lines.append('# HELP ' + name + ' ' + description)
+        lines.append('# TYPE ' + name + ' ' + kind)
+        for labels, value in samples:
+            if value is None:
+                continue
+            lines.append(name + label_text(labels) + ' ' + repr(float(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def by_worker(families_by_pid):
+    """merges several workers' metric families into one list, labelling each sample with its worker's pid"""
+    merged = {}
+    for pid, families in families_by_pid.items():
+        for name, kind, description, samples in families:
+            family = merged.setdefault(name, (name, kind, description, []))
+            family[3].extend((dict(labels, worker=str(pid)), value) for labels, value in samples)
+    return list(merged.values())
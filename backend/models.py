@@ -0,0 +1,120 @@
+"""the stops and departures a refresh builds, holding references to cached stop and trip records"""
+import dataclasses
+import datetime
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+
+@dataclass(slots=True)
+class Stop:
+    """a stop or station on a board, shared by every departure listed for it
+
+    info is the stop's record in the stop store, referenced rather than copied,
+    and is empty for stations. filters holds the destination filter of every
+    group showing the stop.
+    """
+    code: str
+    type: Optional[str]
+    info: dict
+    filters: list
+
+    @property
+    def indicator(self):
+        return self.info.get('indicator')
+
+    @property
+    def icon(self):
+        return self.info.get('icon')
+
+    @property
+    def long_name(self):
+        return self.info.get('long_name')
+
+
+@dataclass(slots=True)
+class Departure:
+    """one departure from a stop, as scraped and with its display overrides applied
+
+    stop, trip and destination_stop point at the shared Stop and at the trip
+    and stop cache records. destination, via and notes are what the boards
+    show; page_display keeps them as they were before any rules ran, so a
+    group's own rules can start again from there. service_line_name is set by
+    rules renaming the service.
+    """
+    stop: Stop
+    bay: Optional[str]
+    service_slug: str
+    line_name: str
+    page_destination: str
+    trip_id: str
+    trip: dict
+    destination_stop: dict
+    scheduled: str
+    expected: Optional[str]
+    scheduled_dt: datetime.datetime
+    expected_dt: datetime.datetime
+    circular: bool
+    via_atco: Tuple[str, ...]
+    destination: Optional[str]
+    via: Optional[str] = None
+    notes: Optional[str] = None
+    service_line_name: Optional[str] = None
+    page_display: Tuple[Optional[str], Optional[str], Optional[str]] = (None, None, None)
+
+    @property
+    def destination_atco(self):
+        return self.destination_stop['atco_code']
+
+    @property
+    def key(self):
+        """identifies the departure across refreshes: its trip and the stop it leaves from"""
+        return self.trip_id + '/' + self.stop.code
+
+    def keep_page_display(self):
+        """remembers the current display as the one rules start from"""
+        self.page_display = (self.destination, self.via, self.notes)
+
+    def with_page_display(self):
+        """returns a copy with the display as it was before any rules ran"""
+        destination, via, notes = self.page_display
+        return dataclasses.replace(self, destination=destination, via=via, notes=notes, service_line_name=None)
+
+    def to_summary(self):
+        """returns the api summary of the departure"""
+        return {
+            'stop' : {'indicator':self.stop.indicator,'icon':self.stop.icon,'bay':self.bay},
+            'service' : self.line_name,
+            'destination' : self.destination,
+            'via': self.via,
+            'notes': self.notes,
+            'scheduled' : self.scheduled,
+            'scheduled_dt' : self.scheduled_dt,
+            'expected' : self.expected,
+            'operator' : self.trip['operator']['name'],
+            'expected_dt': self.expected_dt,
+            'key': self.key,
+            'debug': ''
+        }
+
+    def to_debug(self):
+        """returns everything scraped and worked out for the departure, naming shared records by id rather than copying them"""
+        return {
+            'key': self.key,
+            'stop': self.stop.code,
+            'bay': self.bay,
+            'service_slug': self.service_slug,
+            'line_name': self.line_name,
+            'service_line_name': self.service_line_name,
+            'page_destination': self.page_destination,
+            'trip_id': self.trip_id,
+            'operator': self.trip['operator']['name'],
+            'destination_atco': self.destination_atco,
+            'scheduled': self.scheduled,
+            'expected': self.expected,
+            'scheduled_dt': self.scheduled_dt,
+            'expected_dt': self.expected_dt,
+            'circular': self.circular,
+            'via_atco': list(self.via_atco),
+            'display': {'destination': self.destination, 'via': self.via, 'notes': self.notes},
+            'page_display': dict(zip(('destination', 'via', 'notes'), self.page_display)),
+        }
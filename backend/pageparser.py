@@ -0,0 +1,73 @@
+"""single-pass parser for the departures tables on bustimes.org stop and station pages"""
+from typing import NamedTuple, Optional
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+# --- Only the departures panel is built into a tree, the rest of the page is skipped ---
+DEPARTURES_ONLY = SoupStrainer(id='departures')
+
+
+class DepartureRow(NamedTuple):
+    """one row of a departures table"""
+    service_slug: str
+    line_name: str
+    destination: str
+    scheduled: str
+    expected: Optional[str]
+    bay: Optional[str]
+    trip_id: str
+
+
+def column_name(cell):
+    """returns a header cell's text normalised for matching, e.g. 'Ex\xadpected' -> 'expected'"""
+    return cell.get_text().replace('\xad', '').strip().lower()
+
+
+def parse_departures(html):
+    """returns a DepartureRow for every departure listed on a stop or station page
+
+    Columns are located from each table's header row, so the optional Expected
+    and Bay columns are picked up wherever they appear. Rows missing a service
+    or trip link are skipped.
+    """
+    soup = BeautifulSoup(html, 'html.parser', parse_only=DEPARTURES_ONLY)
+    rows = []
+    for table in soup.find_all('table'):
+        columns = None
+        for tr in table.find_all('tr'):
+            cells = tr.find_all(['td', 'th'], recursive=False)
+            if columns is None:
+                columns = {column_name(cell): index for index, cell in enumerate(cells)}
+                continue
+
+            row = parse_row(cells, columns)
+            if row is not None:
+                rows.append(row)
+    return rows
+
+
+def parse_row(cells, columns):
+    """builds a DepartureRow from a row's cells using the header column positions"""
+    def text(name):
+        index = columns.get(name)
+        if index is None or index >= len(cells):
+            return None
+        return cells[index].get_text().strip()
+
+    try:
+        service = cells[0].a
+        trip = cells[columns.get('scheduled', 2)].a
+    except IndexError:
+        return None
+    if service is None or trip is None:
+        return None
+
+    return DepartureRow(
+        service_slug=service['href'].replace('/services/', '').split('?')[0],
+        line_name=service.get_text(),
+        destination=text('to'),
+        scheduled=text('scheduled'),
+        expected=text('expected'),
+        bay=text('bay'),
+        trip_id=trip['href'].replace('/trips/', ''),
+    )
@@ -0,0 +1,118 @@
+"""writes json snapshots to disk atomically from a background thread"""
+import atexit
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+# --- orjson is used when it's installed, otherwise the standard library encoder ---
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = logging.getLogger(__name__)
+
+
+def dumps(data, sort_keys=False):
+    """serialises data to compact json bytes, turning anything json can't hold into a string"""
+    if orjson is not None:
+        # Datetimes are passed through to str() so the output matches the standard encoder's
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(data, default=str, option=option)
+    return json.dumps(data, separators=(',', ':'), sort_keys=sort_keys, default=str).encode('utf-8')
+
+
+def write_atomic(path, content):
+    """writes bytes to a temporary file beside path and renames it into place
+
+    Readers see either the old file or the new one, never a partial write.
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, 0o644) # mkstemp creates files readable by the owner only
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+class SnapshotWriter:
+    """persists the latest data for each path off the caller's thread
+
+    submit() only records the data and returns. The writer thread serialises
+    whatever is pending, so a burst of submits for a path becomes one write of
+    the newest data, and a file is left alone when its content hasn't changed
+    since it was last written.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._digests = {}
+        self._writing = False
+        self._ready = threading.Condition()
+        self._thread = None
+        self.stats = {'submitted': 0, 'written': 0, 'unchanged': 0, 'errors': 0}
+        atexit.register(self.flush)
+
+    def submit(self, path, data, sort_keys=False):
+        """queues data to be written to path, replacing anything still queued for it"""
+        with self._ready:
+            self._pending[path] = (data, sort_keys)
+            self.stats['submitted'] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='snapshot-writer', daemon=True)
+                self._thread.start()
+            self._ready.notify_all()
+
+    def flush(self, timeout=10):
+        """waits for everything queued so far to be written, returning False on timeout"""
+        with self._ready:
+            return self._ready.wait_for(lambda: not self._pending and not self._writing, timeout)
+
+    def counters(self):
+        """returns submit, write and skip counts"""
+        return dict(self.stats)
+
+    def _run(self):
+        """background loop writing whatever is pending"""
+        while True:
+            with self._ready:
+                self._ready.wait_for(lambda: self._pending)
+                pending, self._pending = self._pending, {}
+                self._writing = True
+
+            for path, (data, sort_keys) in pending.items():
+                try:
+                    self._write(path, data, sort_keys)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    log.exception("Error writing %s: %s", path, e)
+
+            with self._ready:
+                self._writing = False
+                self._ready.notify_all()
+
+    def _write(self, path, data, sort_keys):
+        """serialises and writes one file unless it matches what was last written there"""
+        content = dumps(data, sort_keys=sort_keys)
+        digest = hashlib.sha1(content).digest()
+        if self._digests.get(path) == digest and os.path.exists(path):
+            self.stats['unchanged'] += 1
+            return
+        write_atomic(path, content)
+        self._digests[path] = digest
+        self.stats['written'] += 1
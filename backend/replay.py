@@ -0,0 +1,109 @@
+"""records bustimes.org responses to a fixture directory and replays them, for running the pipeline offline"""
+import collections
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+import fetcher
+from bustimes import BASE_URL
+from persistence import write_atomic
+
+
+def fixture_path(fixture_dir, url):
+    """returns the file a url's response is kept in, named after its path and query"""
+    split = urllib.parse.urlsplit(url)
+    name = split.path.strip('/') + ('?' + split.query if split.query else '')
+    return os.path.join(fixture_dir, urllib.parse.quote(name, safe=''))
+
+
+class RecordingAdapter(HTTPAdapter):
+    """sends requests as normal, saving the body of every successful response as a fixture"""
+
+    def __init__(self, fixture_dir, **kwargs):
+        kwargs.setdefault('pool_maxsize', fetcher.PER_HOST_LIMIT)
+        super().__init__(**kwargs)
+        self.fixture_dir = fixture_dir
+        self.recorded = 0
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        if response.status_code == 200:
+            write_atomic(fixture_path(self.fixture_dir, request.url), response.content)
+            self.recorded += 1
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    """answers requests from a fixture directory instead of the network
+
+    Every request waits latency seconds, plus up to jitter more, to stand in
+    for the round trip. Urls without a fixture get a 404. Requests are counted
+    by the first part of their path, e.g. 'stops' or 'api/trips'.
+    """
+
+    def __init__(self, fixture_dir, latency=0.0, jitter=0.0):
+        super().__init__()
+        self.fixture_dir = fixture_dir
+        self.latency = latency
+        self.jitter = jitter
+        self._lock = threading.Lock()
+        self.requests = collections.Counter()
+        self.missing = collections.Counter()
+
+    def send(self, request, **kwargs):
+        path = urllib.parse.urlsplit(request.url).path.strip('/').split('/')
+        kind = '/'.join(path[:2]) if path[0] == 'api' else path[0]
+        with self._lock:
+            self.requests[kind] += 1
+
+        if self.latency or self.jitter:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+        response = Response()
+        response.request = request
+        response.url = request.url
+        response.encoding = 'utf-8'
+        response.headers = CaseInsensitiveDict()
+        try:
+            with open(fixture_path(self.fixture_dir, request.url), 'rb') as f:
+                response._content = f.read()
+            response.status_code = 200
+        except FileNotFoundError:
+            with self._lock:
+                self.missing[kind] += 1
+            response._content = b''
+            response.status_code = 404
+        return response
+
+    def close(self):
+        pass
+
+    def reset(self):
+        """clears the request counts"""
+        with self._lock:
+            self.requests.clear()
+            self.missing.clear()
+
+
+def install(client, adapter):
+    """routes a BustimesClient's requests to bustimes.org through an adapter"""
+    client.session.mount(BASE_URL, adapter)
+    return adapter
+
+
+def install_from_env(client, environ=os.environ):
+    """installs a replay or recording adapter if BUSTIMES_REPLAY or BUSTIMES_RECORD names a fixture directory
+
+    BUSTIMES_REPLAY_LATENCY sets the replayed round trip in seconds.
+    """
+    if environ.get('BUSTIMES_REPLAY'):
+        return install(client, ReplayAdapter(environ['BUSTIMES_REPLAY'], latency=float(environ.get('BUSTIMES_REPLAY_LATENCY', 0))))
+    if environ.get('BUSTIMES_RECORD'):
+        return install(client, RecordingAdapter(environ['BUSTIMES_RECORD']))
+    return None
@@ -0,0 +1,91 @@
+"""departures response bodies encoded once per snapshot, with compressed and board-sized variants"""
+import collections
+import gzip
+import threading
+
+# --- brotli (in requirements.txt) is offered to clients that accept it, falling back to just gzip if it isn't installed ---
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# --- Board sizes rendered ahead of requests, as shown by printDepartures (10, 15 and 17 rows) ---
+LIMITS = (10, 15, 17)
+
+# --- Bodies smaller than this aren't worth compressing ---
+MIN_COMPRESS_BYTES = 512
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+class Rendered:
+    """one view of a snapshot encoded as json bytes, plus gzip and brotli copies when worth having
+
+    Each encoding gets its own strong etag, the snapshot's with the limit and
+    encoding appended, as the bytes differ.
+    """
+
+    __slots__ = ('etag', 'bodies')
+
+    def __init__(self, body, etag):
+        self.etag = etag
+        self.bodies = {'identity': body}
+        if len(body) >= MIN_COMPRESS_BYTES:
+            self.bodies['gzip'] = gzip.compress(body, GZIP_LEVEL, mtime=0)
+            if brotli is not None:
+                self.bodies['br'] = brotli.compress(body, quality=BROTLI_QUALITY)
+
+    def select(self, accept_encodings):
+        """returns the encoding, body and etag to send a client with the given Accept-Encoding"""
+        for encoding in ('br', 'gzip'):
+            if encoding in self.bodies and accept_encodings[encoding]:
+                return encoding, self.bodies[encoding], self.etag + '-' + encoding
+        return 'identity', self.bodies['identity'], self.etag
+
+
+class ResponseCache:
+    """the rendered views of each group's latest snapshot, rebuilt once when its etag changes
+
+    The full list and every board size in limits are rendered together, so
+    polls for any of them only pick bytes. Other limits are rendered per
+    request.
+    """
+
+    def __init__(self, dumps, limits=LIMITS):
+        self.dumps = dumps
+        self.limits = limits
+        self._lock = threading.Lock()
+        self._views = {}
+        self.stats = {'renders': 0, 'uncached': 0}
+        self.served = collections.Counter()
+
+    def render(self, departures, etag, limit=None):
+        """encodes departures, or the first limit of them, as a Rendered view"""
+        if limit is not None:
+            departures = departures[:limit]
+            etag += '-' + str(limit)
+        return Rendered((self.dumps(departures) + '\n').encode('utf-8'), etag)
+
+    def get(self, name, snapshot, limit=None):
+        """returns the Rendered view of a group's snapshot, at most limit departures long if given"""
+        with self._lock:
+            etag, views = self._views.get(name, (None, None))
+            if etag != snapshot.etag:
+                views = {None: self.render(snapshot.departures, snapshot.etag)}
+                for size in self.limits:
+                    views[size] = self.render(snapshot.departures, snapshot.etag, size)
+                self._views[name] = (snapshot.etag, views)
+                self.stats['renders'] += 1
+        if limit in views:
+            return views[limit]
+        self.stats['uncached'] += 1
+        return self.render(snapshot.departures, snapshot.etag, limit)
+
+    def count(self, encoding, not_modified):
+        """counts a response sent, by encoding, or as not_modified"""
+        self.served['not_modified' if not_modified else encoding] += 1
+
+    def counters(self):
+        """returns how many snapshots and per-request views were rendered, and responses sent by encoding"""
+        return dict(self.stats, served=dict(self.served), brotli=brotli is not None)
@@ -0,0 +1,120 @@
+"""declarative overrides for how departures are displayed, compiled into lookup tables"""
+import json
+
+# --- Keys a rule can set, and the Departure attribute each one goes to ---
+FIELDS = {
+    'destination': 'destination',
+    'via': 'via',
+    'notes': 'notes',
+    'line_name': 'service_line_name',
+}
+
+
+def compile_set(values):
+    """turns a rule's set values into (attribute, value) pairs, rejecting unknown fields"""
+    try:
+        return tuple((FIELDS[key], value) for key, value in values.items())
+    except KeyError as e:
+        raise ValueError("Unknown display rule field: " + e.args[0]) from None
+
+
+def apply_set(departure, values):
+    """copies a rule's compiled values onto a departure's display and service fields"""
+    for attribute, value in values:
+        setattr(departure, attribute, value)
+
+
+class ServiceRule:
+    """overrides for every service whose slug contains a given string"""
+
+    def __init__(self, rule):
+        self.slug_contains = rule['slug_contains']
+        self.values = compile_set(rule.get('set', {}))
+        self.by_via = {}
+        for case in rule.get('via', []):
+            self.by_via.setdefault(tuple(case['via_atco']), compile_set(case['set']))
+        self.by_destination = {}
+        for case in rule.get('destinations', []):
+            for atco_code in case['destination_atco']:
+                self.by_destination.setdefault(atco_code, compile_set(case['set']))
+
+    def apply(self, departure, via_key, destination_atco):
+        """applies the service's own values, then its first matching via or destination case"""
+        apply_set(departure, self.values)
+        case = self.by_via.get(via_key) or self.by_destination.get(destination_atco)
+        if case is not None:
+            apply_set(departure, case)
+
+
+class DisplayRules:
+    """destination, via and notes overrides matched by service, via stops and destination
+
+    Rules are applied in four stages, the same order the original hand-written
+    checks ran in:
+      1. services: the first rule whose slug_contains is in the service slug.
+      2. via: only if no service rule matched, an exact match on the via stops.
+      3. service_destinations: an exact slug and destination stop match.
+      4. destinations: a match on the destination stop alone.
+    Every stage is a dict lookup. Slug substring matches are worked out once
+    per distinct slug and remembered.
+    """
+
+    def __init__(self, *rule_sets):
+        self.services = []
+        self.by_via = {}
+        self.by_service_destination = {}
+        self.by_destination = {}
+        self._slug_rules = {}
+
+        # --- Earlier rule sets take priority over later ones ---
+        for rules in rule_sets:
+            self.services += [ServiceRule(rule) for rule in rules.get('services', [])]
+            for rule in rules.get('via', []):
+                self.by_via.setdefault(tuple(rule['via_atco']), compile_set(rule['set']))
+            for rule in rules.get('service_destinations', []):
+                for atco_code in rule['destination_atco']:
+                    self.by_service_destination.setdefault((rule['slug'], atco_code), compile_set(rule['set']))
+            for rule in rules.get('destinations', []):
+                for atco_code in rule['destination_atco']:
+                    self.by_destination.setdefault(atco_code, compile_set(rule['set']))
+
+    @classmethod
+    def load(cls, *paths):
+        """compiles the rules in one or more rule files, earlier files taking priority"""
+        rule_sets = []
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                rule_sets.append(json.loads(f.read()))
+        return cls(*rule_sets)
+
+    def service_rule(self, slug):
+        """returns the first service rule matching a slug, remembering the answer"""
+        try:
+            return self._slug_rules[slug]
+        except KeyError:
+            pass
+        match = next((rule for rule in self.services if rule.slug_contains in slug), None)
+        self._slug_rules[slug] = match
+        return match
+
+    def apply(self, departure):
+        """sets a departure's display overrides from its service slug, via stops and destination"""
+        slug = departure.service_slug
+        via_key = tuple(departure.via_atco)
+        destination_atco = departure.destination_atco
+
+        service_rule = self.service_rule(slug)
+        if service_rule is not None:
+            service_rule.apply(departure, via_key, destination_atco)
+        else:
+            values = self.by_via.get(via_key)
+            if values is not None:
+                apply_set(departure, values)
+
+        values = self.by_service_destination.get((slug, destination_atco))
+        if values is not None:
+            apply_set(departure, values)
+
+        values = self.by_destination.get(destination_atco)
+        if values is not None:
+            apply_set(departure, values)
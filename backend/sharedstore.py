@@ -0,0 +1,356 @@
+"""shares departures snapshots between worker processes, one of which does all the refreshing"""
+import datetime
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+from snapshots import Snapshot
+
+log = logging.getLogger(__name__)
+
+# --- Workers that haven't published metrics for this many seconds are taken to have gone ---
+METRICS_EXPIRY = 60
+
+
+class SnapshotStore:
+    """the latest snapshot of each stop group in a sqlite file in WAL mode
+
+    Only the refreshing process writes snapshots, and any number read them
+    without blocking it. Departures are
+    stored serialised with dumps, so a reader serving them through the same
+    encoder sends exactly the bytes the writer would have. Readers only load
+    a group's row again once its etag has changed. Each row records the pid
+    of the process that published it, so readers can tell rows left behind by
+    an earlier refresher. Every process also writes its metric families to a
+    metrics table each poll, so any of them can serve the counters of all.
+    """
+
+    def __init__(self, path='_data/snapshots.db', dumps=json.dumps, loads=json.loads):
+        self.path = path
+        self.dumps = dumps
+        self.loads = loads
+        self._lock = threading.Lock()
+        self._loaded = {}
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS snapshots (
+            group_name TEXT PRIMARY KEY, etag TEXT, previous_etag TEXT, stale INTEGER NOT NULL DEFAULT 0,
+            refreshed_at TEXT, modified_at TEXT, duration REAL, departures TEXT, diff TEXT,
+            interval REAL, error TEXT, published_at REAL NOT NULL, owner INTEGER)''')
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(snapshots)')}
+        if 'owner' not in columns:
+            self._db.execute('ALTER TABLE snapshots ADD COLUMN owner INTEGER')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS metrics (
+            role TEXT NOT NULL, pid INTEGER NOT NULL, families TEXT NOT NULL, published_at REAL NOT NULL,
+            PRIMARY KEY (role, pid))''')
+        self._db.commit()
+
+    def put(self, group):
+        """publishes a StopGroup's snapshot and last error
+
+        A group without a snapshot has failed every refresh so far, so any row
+        an earlier refresher left for it is marked stale rather than passed
+        off as this one's.
+        """
+        snapshot = group.snapshot
+        row = (group.name, group.interval, group.error, time.time(), os.getpid())
+        if snapshot is None:
+            with self._lock, self._db:
+                self._db.execute('''INSERT INTO snapshots (group_name, interval, error, published_at, owner) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (group_name) DO UPDATE SET interval = excluded.interval, error = excluded.error,
+                    published_at = excluded.published_at, owner = excluded.owner, stale = 1''', row)
+            return
+        row += (snapshot.etag, snapshot.previous_etag, int(snapshot.stale), snapshot.refreshed_at.isoformat(),
+                snapshot.modified_at.isoformat(), snapshot.duration, self.dumps(snapshot.departures),
+                self.dumps(snapshot.diff) if snapshot.diff is not None else None)
+        with self._lock, self._db:
+            self._db.execute('''INSERT OR REPLACE INTO snapshots (group_name, interval, error, published_at, owner,
+                etag, previous_etag, stale, refreshed_at, modified_at, duration, departures, diff)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', row)
+
+    def get(self, name):
+        """returns a group's latest snapshot, or None if none has been published
+
+        The snapshot is marked stale if its publisher has since marked the row
+        stale.
+        """
+        with self._lock:
+            etag = self._db.execute('SELECT etag, stale FROM snapshots WHERE group_name = ?', (name,)).fetchone()
+            if etag is None or etag[0] is None:
+                return None
+            cached = self._loaded.get(name)
+            if cached is not None and cached.etag == etag[0] and cached.stale == bool(etag[1]):
+                return cached
+            row = self._db.execute('''SELECT etag, previous_etag, stale, refreshed_at, modified_at, duration,
+                departures, diff FROM snapshots WHERE group_name = ?''', (name,)).fetchone()
+        etag, previous_etag, stale, refreshed_at, modified_at, duration, departures, diff = row
+        snapshot = Snapshot.restore(
+            self.loads(departures),
+            datetime.datetime.fromisoformat(refreshed_at),
+            datetime.datetime.fromisoformat(modified_at),
+            duration,
+            bool(stale),
+            etag,
+            previous_etag,
+            self.loads(diff) if diff is not None else None,
+        )
+        with self._lock:
+            self._loaded[name] = snapshot
+        return snapshot
+
+    def status(self, name):
+        """returns a group's refresh interval, last error, when it was last published and by which pid"""
+        with self._lock:
+            row = self._db.execute('SELECT interval, error, published_at, owner FROM snapshots WHERE group_name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return {'interval': row[0], 'error': row[1], 'published_at': row[2], 'owner': row[3]}
+
+    def put_metrics(self, role, families):
+        """publishes this process's metric families under a role, 'refresher' or 'worker'"""
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO metrics (role, pid, families, published_at) VALUES (?, ?, ?, ?)',
+                (role, os.getpid(), json.dumps(families), time.time()))
+
+    def get_metrics(self, role, since=0.0):
+        """returns {pid: metric families} published under a role since a unix time, latest first"""
+        with self._lock:
+            rows = self._db.execute('SELECT pid, families FROM metrics WHERE role = ? AND published_at >= ? ORDER BY published_at DESC',
+                (role, since)).fetchall()
+        return {pid: json.loads(families) for pid, families in rows}
+
+
+class RefreshLock:
+    """an exclusive lock file held by whichever process refreshes the snapshots
+
+    The operating system releases it when that process exits, so another can
+    take over.
+    """
+
+    def __init__(self, path='_data/refresher.lock'):
+        self.path = path
+        self._file = None
+
+    @property
+    def held(self):
+        return self._file is not None
+
+    def try_acquire(self):
+        """takes the lock if no other process holds it, returning whether this process now does"""
+        if self._file is not None:
+            return True
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        f = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), 'r+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        # --- Overwrite the pid and then cut off what's left, so the file is never read empty ---
+        f.seek(0)
+        f.write(str(os.getpid()))
+        f.truncate()
+        f.flush()
+        self._file = f
+        return True
+
+    def holder(self):
+        """returns the pid of the process that last took the lock, as written in the lock file, or None"""
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+
+class SharedRefresher:
+    """a Refresher shared by several processes through a SnapshotStore
+
+    The first process to start takes the refresh lock and runs the refresher,
+    publishing every snapshot to the store. The others serve snapshots read
+    from the store, checking it every poll seconds, and keep trying the lock
+    so one of them takes over if the refreshing process goes away. It has the
+    same interface as Refresher for the routes.
+
+    A snapshot the store has marked stale, or one published by a process other
+    than the lock's current holder, is served through the refresher's stale
+    path, so departures that have gone keep dropping off it.
+
+    Every poll, each process publishes its worker_metrics families to the
+    store, and the refreshing process its refresher_metrics too, so
+    metric_families gives the same counters whichever process is asked.
+    """
+
+    def __init__(self, refresher, store, lock, poll=1.0, refresher_metrics=None, worker_metrics=None):
+        self.refresher = refresher
+        self.store = store
+        self.lock = lock
+        self.poll = poll
+        self.refresher_metrics = refresher_metrics
+        self.worker_metrics = worker_metrics
+        self.groups = refresher.groups
+        refresher.publish = store.put
+        self._snapshots = {}
+        self._orphaned = set()
+        self._stale = {}
+        self._changed = threading.Condition()
+        self._start_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def role(self):
+        return 'refresher' if self.lock.held else 'reader'
+
+    def start(self):
+        """takes the refresh lock if it's free, and starts the refresher or the store poller"""
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            if self.lock.try_acquire():
+                log.info("Process %d is refreshing departures", os.getpid())
+                self._take_over()
+            else:
+                self._check_owners()
+            self._thread = threading.Thread(target=self._run, name='snapshot-reader', daemon=True)
+            self._thread.start()
+
+    def get(self, name, timeout=60):
+        """returns the latest snapshot for a group, waiting for one to be published on a cold start"""
+        if self.lock.held:
+            return self.refresher.get(name, timeout=timeout)
+        snapshot = self._read(name)
+        deadline = time.monotonic() + timeout
+        while snapshot is None and time.monotonic() < deadline:
+            time.sleep(min(self.poll, 0.2))
+            snapshot = self._read(name)
+        if snapshot is None:
+            status = self.store.status(name) or {}
+            raise RuntimeError(status.get('error') or "No departures snapshot available for " + name)
+        return snapshot
+
+    def wait_for_change(self, name, etag, timeout=None):
+        """blocks until a group's snapshot differs from etag, returning it, or None on timeout"""
+        if self.lock.held:
+            return self.refresher.wait_for_change(name, etag, timeout)
+        with self._changed:
+            self._changed.wait_for(lambda: self._etag(name) not in (None, etag), timeout)
+        snapshot = self._snapshots.get(name)
+        if snapshot is None or snapshot.etag == etag:
+            return None
+        return snapshot
+
+    def status(self):
+        """returns snapshot age and refresh duration for every group, as the refreshing process last published"""
+        if self.lock.held:
+            return self.refresher.status()
+        out = {}
+        for name in self.groups:
+            snapshot = self._read(name)
+            status = self.store.status(name) or {}
+            out[name] = {
+                'interval': status.get('interval'),
+                'refreshing': None,
+                'error': status.get('error'),
+                'stale': snapshot.stale if snapshot else None,
+                'refreshed_at': snapshot.refreshed_at.isoformat() if snapshot else None,
+                'modified_at': snapshot.modified_at.isoformat() if snapshot else None,
+                'age': round(snapshot.age, 3) if snapshot else None,
+                'refresh_duration': round(snapshot.duration, 3) if snapshot else None,
+                'departures': len(snapshot.departures) if snapshot else None,
+            }
+        return out
+
+    def metric_families(self):
+        """returns the refreshing process's metric families, then every live worker's labelled with its pid"""
+        families = []
+        try:
+            if not self.lock.held:
+                families = next(iter(self.store.get_metrics('refresher').values()), [])
+            elif self.refresher_metrics is not None:
+                families = self.refresher_metrics()
+            workers = self.store.get_metrics('worker', time.time() - METRICS_EXPIRY)
+        except sqlite3.Error as e:
+            log.warning("Error reading shared metrics: %s", e)
+            workers = {}
+        if self.worker_metrics is not None:
+            workers[os.getpid()] = self.worker_metrics()
+        return families + metrics.by_worker(workers)
+
+    def _publish_metrics(self):
+        """writes this process's metric families to the store"""
+        try:
+            if self.worker_metrics is not None:
+                self.store.put_metrics('worker', self.worker_metrics())
+            if self.lock.held and self.refresher_metrics is not None:
+                self.store.put_metrics('refresher', self.refresher_metrics())
+        except sqlite3.Error as e:
+            log.warning("Error publishing metrics: %s", e)
+
+    def _etag(self, name):
+        snapshot = self._snapshots.get(name)
+        return snapshot.etag if snapshot else None
+
+    def _take_over(self):
+        """starts the refresher, first seeding each group with its snapshot from the store so it's served stale rather than waited on"""
+        for name in self.groups:
+            try:
+                snapshot = self.store.get(name)
+            except sqlite3.Error as e:
+                log.warning("Error reading shared %s snapshot: %s", name, e)
+                continue
+            if snapshot is not None:
+                self.refresher.seed(name, snapshot)
+        self.refresher.start()
+
+    def _check_owners(self):
+        """notes which groups' rows weren't published by the process now holding the refresh lock
+
+        Left as it was if the lock file can't be read, rather than taking every row for orphaned.
+        """
+        holder = self.lock.holder()
+        if holder is None:
+            return
+        self._orphaned = {name for name in self.groups if (self.store.status(name) or {}).get('owner') != holder}
+
+    def _expired(self, name, snapshot):
+        """returns a stale snapshot from the store without the departures that have gone, redone at most every poll"""
+        source, expired, at = self._stale.get(name, (None, None, 0.0))
+        if source is not snapshot or time.monotonic() - at >= self.poll:
+            expired = self.refresher.stale_snapshot(snapshot, previous=expired)
+            self._stale[name] = (snapshot, expired, time.monotonic())
+        return expired
+
+    def _read(self, name):
+        """loads a group's snapshot from the store, waking streams if it changed"""
+        snapshot = self.store.get(name)
+        if snapshot is not None and (snapshot.stale or name in self._orphaned):
+            snapshot = self._expired(name, snapshot)
+        if snapshot is not None and self._etag(name) != snapshot.etag:
+            with self._changed:
+                self._snapshots[name] = snapshot
+                self._changed.notify_all()
+        return snapshot
+
+    def _run(self):
+        """background loop following the store, taking over refreshing if the lock comes free, and publishing metrics"""
+        while True:
+            time.sleep(self.poll)
+            if not self.lock.held:
+                try:
+                    self._check_owners()
+                    for name in self.groups:
+                        self._read(name)
+                except sqlite3.Error as e:
+                    log.warning("Error reading shared snapshots: %s", e)
+                if self.lock.try_acquire():
+                    log.info("Process %d took over refreshing departures", os.getpid())
+                    self._take_over()
+            self._publish_metrics()
@@ -0,0 +1,261 @@
+"""keeps a prebuilt departures snapshot for each stop group fresh in the background"""
+import datetime
+import hashlib
+import json
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+def diff_departures(old, new):
+    """returns the keyed changes turning one departures summary into another
+
+    Departures are matched on their 'key' (trip id and stop). The new order of
+    keys is included so a client can re-sort without the full list.
+    """
+    old_by_key = {d['key']: d for d in old}
+    new_by_key = {d['key']: d for d in new}
+    return {
+        'added': [d for key, d in new_by_key.items() if key not in old_by_key],
+        'removed': [key for key in old_by_key if key not in new_by_key],
+        'changed': [d for key, d in new_by_key.items() if key in old_by_key and old_by_key[key] != d],
+        'order': [d['key'] for d in new],
+    }
+
+
+class Snapshot:
+    """a built departures summary along with when and how quickly it was built
+
+    When the content changed from the previous snapshot, diff holds the changes
+    from it and previous_etag identifies the snapshot the diff applies to. A
+    stale snapshot is the last good one reused after a failed refresh, so its
+    refreshed_at is when that one was built.
+    """
+
+    __slots__ = ('departures', 'refreshed_at', 'modified_at', 'duration', 'stale', 'etag', 'previous_etag', 'diff')
+
+    def __init__(self, departures, refreshed_at, duration, previous=None, stale=False):
+        self.departures = departures
+        self.refreshed_at = refreshed_at
+        self.duration = duration
+        self.stale = stale
+        self.etag = hashlib.sha1(json.dumps(departures, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        if stale:
+            self.etag += '-stale'
+
+        # --- Only move Last-Modified on when the content actually changed ---
+        if previous is not None and previous.etag == self.etag:
+            self.modified_at = previous.modified_at
+        elif stale:
+            self.modified_at = datetime.datetime.now(datetime.UTC)
+        else:
+            self.modified_at = refreshed_at
+
+        self.previous_etag = None
+        self.diff = None
+        if previous is not None and previous.etag != self.etag:
+            self.previous_etag = previous.etag
+            self.diff = diff_departures(previous.departures, departures)
+
+    @classmethod
+    def restore(cls, departures, refreshed_at, modified_at, duration, stale, etag, previous_etag, diff):
+        """rebuilds a snapshot as another process built it, keeping its etag and diff"""
+        snapshot = cls.__new__(cls)
+        snapshot.departures = departures
+        snapshot.refreshed_at = refreshed_at
+        snapshot.modified_at = modified_at
+        snapshot.duration = duration
+        snapshot.stale = stale
+        snapshot.etag = etag
+        snapshot.previous_etag = previous_etag
+        snapshot.diff = diff
+        return snapshot
+
+    @property
+    def age(self):
+        """seconds since the snapshot was built"""
+        return (datetime.datetime.now(datetime.UTC) - self.refreshed_at).total_seconds()
+
+
+class StopGroup:
+    """a named stop group refreshed on its own interval"""
+
+    def __init__(self, name, config, interval):
+        self.name = name
+        self.config = config
+        self.interval = interval
+        self.snapshot = None
+        self.error = None
+        self.next_due = 0.0
+        self.in_flight = None
+
+
+class Refresher:
+    """refreshes each stop group on its interval and hands out the latest snapshot
+
+    build is called with a dict of group name to group config for every group
+    due at once, so stops they share are scraped once, and must return a dict
+    of group name to departures summary, or to the exception that stopped
+    just that group being built. Builds are run one at a time, and
+    callers asking for a group that is already being refreshed wait on that
+    refresh rather than starting another.
+
+    When a refresh fails, a group that has a snapshot keeps serving it marked
+    stale. expire, if given, is called with its departures and the current
+    time to drop the ones that have gone since. publish, if given, is called
+    with each StopGroup after it is refreshed, successfully or not.
+    """
+
+    def __init__(self, build, tick=1.0, expire=None, publish=None):
+        self.build = build
+        self.tick = tick
+        self.expire = expire
+        self.publish = publish
+        self.groups = {}
+        self.refreshes = 0
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._thread = None
+
+    def add_group(self, name, config, interval):
+        """registers a stop group to be kept fresh every interval seconds"""
+        self.groups[name] = StopGroup(name, config, interval)
+
+    def seed(self, name, snapshot):
+        """gives a group with no snapshot yet one built elsewhere, served stale until the group's first refresh"""
+        group = self.groups[name]
+        if group.snapshot is None:
+            group.snapshot = self.stale_snapshot(snapshot)
+
+    def start(self):
+        """starts the background refresh thread if it isn't already running"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='departures-refresher', daemon=True)
+            self._thread.start()
+
+    def get(self, name, timeout=60):
+        """returns the latest snapshot for a group, waiting for the first refresh on a cold start"""
+        group = self.groups[name]
+        if group.snapshot is None:
+            self.refresh(name, timeout=timeout)
+        if group.snapshot is None:
+            raise RuntimeError(group.error or "No departures snapshot available for " + name)
+        return group.snapshot
+
+    def refresh(self, *names, timeout=60):
+        """rebuilds the named groups' snapshots together, waiting on any already in flight"""
+        with self._lock:
+            owned = {}
+            waiting = []
+            for name in names:
+                group = self.groups[name]
+                if group.in_flight is None:
+                    group.in_flight = owned[name] = threading.Event()
+                else:
+                    waiting.append(group.in_flight)
+
+        if owned:
+            try:
+                with self._build_lock:
+                    started = time.perf_counter()
+                    summaries = self.build({name: self.groups[name].config for name in owned})
+                    duration = time.perf_counter() - started
+                refreshed_at = datetime.datetime.now(datetime.UTC)
+                for name in owned:
+                    if isinstance(summaries[name], Exception):
+                        log.warning("Error refreshing %s departures: %s", name, summaries[name])
+                        self.fail(name, summaries[name])
+                        continue
+                    group = self.groups[name]
+                    group.snapshot = Snapshot(summaries[name], refreshed_at, duration, group.snapshot)
+                    group.error = None
+            except Exception as e:
+                log.exception("Error refreshing %s departures: %s", ', '.join(owned), e)
+                for name in owned:
+                    self.fail(name, e)
+            finally:
+                with self._lock:
+                    for name, event in owned.items():
+                        group = self.groups[name]
+                        group.next_due = time.monotonic() + group.interval
+                        group.in_flight = None
+                        event.set()
+
+            if self.publish is not None:
+                for name in owned:
+                    try:
+                        self.publish(self.groups[name])
+                    except Exception as e:
+                        log.exception("Error publishing %s departures: %s", name, e)
+
+            with self._changed:
+                self.refreshes += 1
+                self._changed.notify_all()
+
+        for event in waiting:
+            event.wait(timeout)
+
+    def fail(self, name, error):
+        """records a group's failed refresh, serving its last good snapshot stale if it has one"""
+        group = self.groups[name]
+        group.error = str(error)
+        if group.snapshot is not None:
+            group.snapshot = self.stale_snapshot(group.snapshot)
+
+    def stale_snapshot(self, snapshot, previous=None):
+        """returns the last good snapshot again, marked stale and without departures that have gone
+
+        The result is diffed against previous if given, otherwise against snapshot.
+        """
+        departures = snapshot.departures
+        if self.expire is not None:
+            departures = self.expire(departures, datetime.datetime.now().astimezone())
+        return Snapshot(departures, snapshot.refreshed_at, snapshot.duration, previous or snapshot, stale=True)
+
+    def wait_for_change(self, name, etag, timeout=None):
+        """blocks until a group's snapshot differs from etag, returning it, or None on timeout"""
+        group = self.groups[name]
+        with self._changed:
+            self._changed.wait_for(lambda: group.snapshot is not None and group.snapshot.etag != etag, timeout)
+        snapshot = group.snapshot
+        if snapshot is None or snapshot.etag == etag:
+            return None
+        return snapshot
+
+    def wait_for_refresh(self, seen, timeout=None):
+        """blocks until the count of finished refreshes, of any group, moves on from seen, returning the new count"""
+        with self._changed:
+            self._changed.wait_for(lambda: self.refreshes != seen, timeout)
+            return self.refreshes
+
+    def status(self):
+        """returns snapshot age and refresh duration for every group"""
+        out = {}
+        for name, group in self.groups.items():
+            snapshot = group.snapshot
+            out[name] = {
+                'interval': group.interval,
+                'refreshing': group.in_flight is not None,
+                'error': group.error,
+                'stale': snapshot.stale if snapshot else None,
+                'refreshed_at': snapshot.refreshed_at.isoformat() if snapshot else None,
+                'modified_at': snapshot.modified_at.isoformat() if snapshot else None,
+                'age': round(snapshot.age, 3) if snapshot else None,
+                'refresh_duration': round(snapshot.duration, 3) if snapshot else None,
+                'departures': len(snapshot.departures) if snapshot else None,
+            }
+        return out
+
+    def _run(self):
+        """background loop refreshing whichever groups are due"""
+        while True:
+            now = time.monotonic()
+            due = [name for name, group in self.groups.items() if group.next_due <= now]
+            if due:
+                self.refresh(*due)
+            time.sleep(self.tick)
@@ -0,0 +1,91 @@
+"""decides which stop pages are worth scraping again, from the departures they showed last time"""
+import datetime
+import threading
+
+# --- How often a stop page is fetched, by how soon its next bus is and whether that bus is tracked ---
+LIVE_INTERVAL = datetime.timedelta(seconds=30)     # a live-tracked bus due within IMMINENT
+IMMINENT_INTERVAL = datetime.timedelta(seconds=60) # any bus due within IMMINENT
+MAX_INTERVAL = datetime.timedelta(minutes=15)      # idle stops, and stops showing no buses at all
+IMMINENT = datetime.timedelta(minutes=20)
+
+
+def stop_interval(departures, now):
+    """returns how long a stop's departures can be reused before its page is worth fetching again
+
+    A page changes when a live expected time moves, when a bus leaves and the
+    next one is listed, and when buses come close enough to be tracked. So a
+    stop with a tracked bus due soon is fetched every LIVE_INTERVAL, one with
+    any bus due soon every IMMINENT_INTERVAL, and an idle one again as its next
+    bus becomes imminent, or after MAX_INTERVAL at the latest.
+    """
+    upcoming = [d for d in departures if d.expected_dt >= now]
+    if not upcoming:
+        return MAX_INTERVAL
+    soon = now + IMMINENT
+    if any(d.expected and d.expected_dt <= soon for d in upcoming):
+        return LIVE_INTERVAL
+    next_dt = min(d.expected_dt for d in upcoming)
+    if next_dt <= soon:
+        return IMMINENT_INTERVAL
+    return min(max(next_dt - soon, IMMINENT_INTERVAL), MAX_INTERVAL)
+
+
+class ScrapedStop:
+    """the departures last built from a stop's page, and when the page is next due"""
+
+    __slots__ = ('departures', 'filters', 'fetched_at', 'next_due')
+
+    def __init__(self, departures, filters, fetched_at, next_due):
+        self.departures = departures
+        self.filters = filters
+        self.fetched_at = fetched_at
+        self.next_due = next_due
+
+
+class StopPlanner:
+    """remembers each stop's departures between refreshes and plans which pages to fetch
+
+    A stop's departures are only reused when they were built with the same
+    destination filters, as rows every filter excluded were never built. The
+    next departure leaving always makes a stop due, since its page will then
+    list another.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stops = {}
+
+    def due(self, stop, filters, now):
+        """returns True if a stop's page should be fetched on this refresh"""
+        scraped = self._stops.get(stop)
+        return scraped is None or scraped.filters != filters or now >= scraped.next_due
+
+    def departures(self, stop):
+        """returns the departures last built for a stop"""
+        return self._stops[stop].departures
+
+    def update(self, stop, filters, departures, now):
+        """stores the departures just built from a stop's page and plans its next fetch"""
+        next_due = now + stop_interval(departures, now)
+        leaving = [d.expected_dt for d in departures if d.expected_dt >= now]
+        if leaving:
+            next_due = min(next_due, min(leaving))
+        with self._lock:
+            self._stops[stop] = ScrapedStop(departures, filters, now, next_due)
+
+    def forget(self, stop=None):
+        """drops one stop's departures, or every stop's, so it is fetched on the next refresh"""
+        with self._lock:
+            if stop is None:
+                self._stops.clear()
+            else:
+                self._stops.pop(stop, None)
+
+    def status(self, now):
+        """returns when each stop was last fetched and how long until it is due again"""
+        with self._lock:
+            return {stop: {
+                'fetched_at': scraped.fetched_at.isoformat(),
+                'due_in': round(max((scraped.next_due - now).total_seconds(), 0.0), 3),
+                'departures': len(scraped.departures),
+            } for stop, scraped in self._stops.items()}
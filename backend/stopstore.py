@@ -0,0 +1,184 @@
+"""on-disk store of bustimes.org stop metadata keyed by atco code and indexed by name"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+# --- Scraped/request keys that were cached alongside stop metadata in the old stops.json ---
+TRANSIENT_KEYS = ('html', 'extras')
+
+# --- Where a stored entry came from; bulk loads don't replace entries fetched from bustimes.org ---
+SOURCE_API = 'bustimes'
+SOURCE_NAPTAN = 'naptan'
+
+log = logging.getLogger(__name__)
+
+
+class StopStore:
+    """stop metadata persisted to sqlite, read through an in-memory cache
+
+    Behaves like a dict of atco code to metadata. Entries are read from the
+    database the first time they are looked up, so a bulk-loaded area of
+    thousands of stops costs nothing until a board needs one. Assignments only
+    mark entries dirty, and flush() writes just the entries whose content
+    changed. Names are indexed for find().
+    """
+
+    def __init__(self, path='_data/stops.db', legacy_path='_data/stops.json'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stops = {}
+        self._encoded = {}
+        self._dirty = set()
+        self.stats = {'hits': 0, 'misses': 0}
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS stops (atco_code TEXT PRIMARY KEY, data TEXT NOT NULL,
+            name TEXT COLLATE NOCASE, common_name TEXT COLLATE NOCASE, source TEXT)''')
+        self._add_name_columns()
+        self._db.execute('CREATE INDEX IF NOT EXISTS stops_name ON stops (name)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS stops_common_name ON stops (common_name)')
+        self._db.commit()
+
+        empty = self._db.execute('SELECT 1 FROM stops LIMIT 1').fetchone() is None
+        if empty and legacy_path and os.path.exists(legacy_path):
+            self.migrate(legacy_path)
+
+    def _add_name_columns(self):
+        """adds the indexed name columns to a database written before they existed, filling them in"""
+        columns = {row[1] for row in self._db.execute('PRAGMA table_info(stops)')}
+        if 'name' in columns:
+            return
+        self._db.execute('ALTER TABLE stops ADD COLUMN name TEXT COLLATE NOCASE')
+        self._db.execute('ALTER TABLE stops ADD COLUMN common_name TEXT COLLATE NOCASE')
+        self._db.execute('ALTER TABLE stops ADD COLUMN source TEXT')
+        rows = []
+        for atco_code, encoded in self._db.execute('SELECT atco_code, data FROM stops').fetchall():
+            data = json.loads(encoded)
+            rows.append((data.get('name'), data.get('common_name'), SOURCE_API, atco_code))
+        self._db.executemany('UPDATE stops SET name = ?, common_name = ?, source = ? WHERE atco_code = ?', rows)
+
+    def migrate(self, legacy_path):
+        """one-shot import of the old stops.json cache, dropping the scraped html and request extras"""
+        try:
+            with open(legacy_path, encoding="utf-8") as f:
+                legacy = json.loads(f.read())
+        except (json.JSONDecodeError, FileNotFoundError):
+            return 0
+        for atco_code, data in legacy.items():
+            # Stations were cached with nothing but their page, so there is no metadata to keep
+            if data.get('atco_code') is None:
+                continue
+            self[atco_code] = data
+        written = self.flush()
+        log.info("Migrated %d stops from %s to %s", written, legacy_path, self.path)
+        return written
+
+    def _load(self, atco_code):
+        """returns an entry, reading it from the database the first time, or raises KeyError"""
+        try:
+            return self._stops[atco_code]
+        except KeyError:
+            pass
+        with self._lock:
+            if atco_code in self._stops:
+                return self._stops[atco_code]
+            row = self._db.execute('SELECT data FROM stops WHERE atco_code = ?', (atco_code,)).fetchone()
+            if row is None:
+                raise KeyError(atco_code)
+            data = self._stops[atco_code] = json.loads(row[0])
+            self._encoded[atco_code] = row[0]
+        return data
+
+    # --- Mapping interface ---
+
+    def __contains__(self, atco_code):
+        try:
+            self._load(atco_code)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, atco_code):
+        return self._load(atco_code)
+
+    def __setitem__(self, atco_code, data):
+        data = {k: v for k, v in data.items() if k not in TRANSIENT_KEYS}
+        with self._lock:
+            self._stops[atco_code] = data
+            self._dirty.add(atco_code)
+
+    def __len__(self):
+        with self._lock:
+            stored = self._db.execute('SELECT COUNT(*) FROM stops').fetchone()[0]
+            return stored + len(self._dirty - self._encoded.keys())
+
+    def get(self, atco_code, default=None):
+        """returns the metadata for a stop, or default if it isn't stored, counting the lookup as a hit or miss"""
+        try:
+            data = self._load(atco_code)
+        except KeyError:
+            self.stats['misses'] += 1
+            return default
+        self.stats['hits'] += 1
+        return data
+
+    def find(self, name, limit=20):
+        """returns the metadata of stored stops whose name or common name starts with name, ignoring case"""
+        pattern = name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        with self._lock:
+            rows = self._db.execute('''SELECT data FROM stops WHERE name LIKE ? ESCAPE '\\' OR common_name LIKE ? ESCAPE '\\'
+                ORDER BY name, atco_code LIMIT ?''', (pattern, pattern, limit)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    # --- Persistence ---
+
+    def load(self, entries, source=SOURCE_NAPTAN, replace=False):
+        """writes many entries straight to the database in one transaction, returning how many were written
+
+        Entries already stored from bustimes.org are kept unless replace is
+        set, since they are what the boards have been showing. Nothing is read
+        into memory; loaded copies of the entries written are dropped so the
+        next lookup reads them back.
+        """
+        rows = []
+        for data in entries:
+            data = {k: v for k, v in data.items() if k not in TRANSIENT_KEYS}
+            rows.append((data['atco_code'], json.dumps(data, sort_keys=True, default=str),
+                         data.get('name'), data.get('common_name'), source))
+        keep = '' if replace else "WHERE stops.source IS NOT '%s'" % SOURCE_API
+        with self._lock:
+            before = self._db.total_changes
+            with self._db:
+                self._db.executemany('''INSERT INTO stops (atco_code, data, name, common_name, source) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (atco_code) DO UPDATE SET data = excluded.data, name = excluded.name,
+                    common_name = excluded.common_name, source = excluded.source ''' + keep, rows)
+            written = self._db.total_changes - before
+            for row in rows:
+                if row[0] not in self._dirty:
+                    self._stops.pop(row[0], None)
+                    self._encoded.pop(row[0], None)
+        return written
+
+    def flush(self):
+        """writes entries changed since the last flush, returning how many were written"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            rows = []
+            for atco_code in dirty:
+                data = self._stops[atco_code]
+                encoded = json.dumps(data, sort_keys=True, default=str)
+                if self._encoded.get(atco_code) != encoded:
+                    self._encoded[atco_code] = encoded
+                    rows.append((atco_code, encoded, data.get('name'), data.get('common_name'), SOURCE_API))
+            if rows:
+                with self._db:
+                    self._db.executemany('''INSERT OR REPLACE INTO stops (atco_code, data, name, common_name, source)
+                        VALUES (?, ?, ?, ?, ?)''', rows)
+        return len(rows)
+
+    def counters(self):
+        """returns hit and miss counts, the entries read into memory and the entries stored"""
+        return dict(self.stats, entries=len(self._stops), stored=len(self))
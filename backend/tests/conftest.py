@@ -0,0 +1,17 @@
+"""shared fixtures: the backend modules on the path, and the pages captured in _data/stops.json"""
+import json
+import os
+import sys
+
+import pytest
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+
+@pytest.fixture(scope='session')
+def captured_pages():
+    """returns the departures page html captured for each stop and station in the old stops.json cache"""
+    with open(os.path.join(BACKEND, '_data', 'stops.json'), encoding='utf-8') as f:
+        stops = json.load(f)
+    return {code: data['html'] for code, data in stops.items() if data.get('html')}
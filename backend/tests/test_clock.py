@@ -0,0 +1,32 @@
+"""placing the bare HH:MM times of stop pages and trips on their dates"""
+import datetime
+
+from clock import RefreshClock
+
+
+def local(*args):
+    return datetime.datetime(*args).astimezone()
+
+
+def time(text):
+    return datetime.datetime.strptime(text, '%H:%M').time()
+
+
+def test_late_bus_from_before_midnight_stays_yesterday():
+    clock = RefreshClock(local(2026, 10, 18, 0, 5))
+    assert clock.page_time('23:55') == local(2026, 10, 17, 23, 55)
+    assert clock.page_time('00:30') == local(2026, 10, 18, 0, 30)
+
+
+def test_tomorrows_first_buses_listed_in_the_evening():
+    clock = RefreshClock(local(2026, 10, 17, 23, 50))
+    assert clock.page_time('05:40') == local(2026, 10, 18, 5, 40)
+    assert clock.page_time('23:20') == local(2026, 10, 17, 23, 20)
+
+
+def test_trip_times_follow_the_departures_date():
+    clock = RefreshClock(local(2026, 10, 17, 23, 50))
+    scheduled = clock.page_time('00:20') # tomorrow's, on a trip that set off before midnight
+    assert clock.trip_time(time('23:30'), scheduled) == local(2026, 10, 17, 23, 30)
+    assert clock.trip_time(time('01:15'), scheduled) == local(2026, 10, 18, 1, 15)
+    assert clock.trip_time(time('01:15')) == local(2026, 10, 18, 1, 15)
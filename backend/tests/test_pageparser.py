@@ -0,0 +1,46 @@
+"""parse_departures over the stop and station pages captured in _data/stops.json"""
+from bs4 import BeautifulSoup
+
+from pageparser import parse_departures
+
+
+def test_station_page_maps_expected_and_bay_from_header(captured_pages):
+    rows = parse_departures(captured_pages['109GDDCCBS01'])
+    assert len(rows) == 11
+    first = rows[0]
+    assert (first.line_name, first.destination, first.scheduled, first.expected, first.bay, first.trip_id) == (
+        'UK900', 'Derby', '00:40', '', '25', '495331114')
+    assert all(row.bay for row in rows)
+
+
+def test_stop_page_maps_expected_from_header(captured_pages):
+    rows = parse_departures(captured_pages['1090DDVS1302'])
+    assert len(rows) == 11
+    assert (rows[0].scheduled, rows[0].expected, rows[0].bay) == ('00:31', '00:31', None)
+    assert rows[1].expected == ''
+
+
+def test_page_without_expected_column(captured_pages):
+    rows = parse_departures(captured_pages['109000009334'])
+    assert len(rows) == 12
+    assert all(row.expected is None and row.bay is None for row in rows)
+    assert (rows[0].line_name, rows[0].destination, rows[0].scheduled, rows[0].trip_id) == (
+        'V1', 'Burton upon Trent', '06:41', '439072643')
+
+
+def test_date_query_stripped_from_service_slugs(captured_pages):
+    html = captured_pages['1090DDVS1302']
+    assert '/services/sw-derby-ashbourne-uttoxeter?date=' in html
+    rows = parse_departures(html)
+    assert rows[0].service_slug == 'sw-derby-ashbourne-uttoxeter'
+    assert all('?' not in row.service_slug for page in captured_pages.values() for row in parse_departures(page))
+
+
+def test_rows_without_links_skipped(captured_pages):
+    soup = BeautifulSoup(captured_pages['109000009334'], 'html.parser')
+    table_rows = soup.select_one('#departures table').find_all('tr')
+    table_rows[1].find('td').a.unwrap()   # no service link
+    table_rows[2].find_all('td')[2].a.unwrap()   # no trip link
+    rows = parse_departures(str(soup))
+    assert len(rows) == 10
+    assert {'439072643', '460840950'}.isdisjoint(row.trip_id for row in rows)
@@ -0,0 +1,195 @@
+"""refreshing a stop whose rows can't all be built: it must be fetched again next time, not reused"""
+import datetime
+import json
+
+import pytest
+
+from conftest import BACKEND
+
+STOP = '109000009334'
+DESTINATION = '1090TEST0001'
+NOW = datetime.datetime.combine(datetime.date(2026, 10, 17), datetime.time(0, 0)).astimezone() # every row on the page is still to come
+
+
+def stop_record(atco_code, name='Derby', common_name='Bus Station'):
+    return {'atco_code': atco_code, 'name': name + ' ' + common_name, 'common_name': common_name,
+            'long_name': name + ', ' + common_name, 'indicator': '', 'icon': None}
+
+
+def trip_record(row, destination=DESTINATION):
+    return {
+        'id': row.trip_id,
+        'operator': {'name': 'Test Buses'},
+        'service': {'line_name': row.line_name},
+        'times': [
+            {'stop': {'atco_code': STOP, 'name': 'Derby Bus Station'}, 'timing_status': 'PTP',
+             'aimed_arrival_time': None, 'aimed_departure_time': row.scheduled},
+            {'stop': {'atco_code': destination, 'name': 'Test Terminus'}, 'timing_status': 'PTP',
+             'aimed_arrival_time': '23:59', 'aimed_departure_time': None},
+        ],
+    }
+
+
+def add_fixture(fixtures, path, body):
+    """saves a response body for the replay client to answer path with"""
+    import replay
+    from bustimes import BASE_URL
+    with open(replay.fixture_path(str(fixtures), BASE_URL + path), 'w', encoding='utf-8') as f:
+        f.write(body)
+
+
+@pytest.fixture
+def fixtures(tmp_path):
+    """the directory of responses the replay client answers with"""
+    path = tmp_path / 'fixtures'
+    path.mkdir()
+    return path
+
+
+@pytest.fixture
+def adapter(fixtures):
+    """a replay adapter answering any url containing one of its failing parts with a 503"""
+    import replay
+
+    class FailingAdapter(replay.ReplayAdapter):
+        def __init__(self, fixture_dir):
+            super().__init__(fixture_dir)
+            self.failing = set()
+
+        def send(self, request, **kwargs):
+            response = super().send(request, **kwargs)
+            if any(part in request.url for part in self.failing):
+                response.status_code = 503
+                response._content = b''
+            return response
+
+    return FailingAdapter(str(fixtures))
+
+
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch, captured_pages, fixtures, adapter):
+    """departures pointed at empty stores in tmp_path and a client replaying only STOP's captured page"""
+    monkeypatch.chdir(BACKEND)
+    import departures
+    import replay
+    from bustimes import BustimesClient
+    from pageparser import parse_departures
+    from stopplanner import StopPlanner
+    from stopstore import StopStore
+    from tripcache import TripCache
+
+    add_fixture(fixtures, '/stops/' + STOP + '/', captured_pages[STOP])
+
+    client = BustimesClient(backoff=0)
+    replay.install(client, adapter)
+    monkeypatch.setattr(departures, 'client', client)
+    monkeypatch.setattr(departures, 'stops_data', StopStore(str(tmp_path / 'stops.db'), legacy_path=None))
+    monkeypatch.setattr(departures, 'trips_data', TripCache(str(tmp_path / 'trips.db'), legacy_path=None))
+    monkeypatch.setattr(departures, 'stop_planner', StopPlanner())
+    monkeypatch.setattr(departures, 'FULL_PATH', str(tmp_path / 'departures full.json'))
+    monkeypatch.setattr(departures, 'SUMMARY_PATH', str(tmp_path / 'departures sumary.json'))
+
+    departures.stops_data[STOP] = stop_record(STOP)
+    departures.stops_data[DESTINATION] = stop_record(DESTINATION, 'Test', 'Terminus')
+    rows = parse_departures(captured_pages[STOP])
+    for row in rows:
+        departures.trips_data[row.trip_id] = trip_record(row)
+    return departures, rows
+
+
+def refresh(departures):
+    """builds STOP's departures as of NOW"""
+    from clock import RefreshClock
+    return departures.get_stop_departures({STOP: {'type': None, 'filters': [None]}}, RefreshClock(NOW))[STOP]
+
+
+def test_built_stop_is_reused(pipeline):
+    departures, rows = pipeline
+    built = refresh(departures)
+    assert len(built) == len(rows)
+    assert not departures.stop_planner.due(STOP, [None], NOW)
+
+
+def test_stop_without_long_name_is_refetched(pipeline, fixtures):
+    departures, rows = pipeline
+    departures.stops_data[STOP] = dict(stop_record(STOP), long_name=None)
+    add_fixture(fixtures, '/api/stops/' + STOP + '/?format=json', json.dumps(stop_record(STOP)))
+
+    built = refresh(departures)
+    assert len(built) == len(rows)
+    assert departures.stops_data[STOP]['long_name'] == 'Derby, Bus Station'
+
+
+def test_row_error_leaves_stop_due(pipeline):
+    departures, rows = pipeline
+    departures.trips_data[rows[0].trip_id] = trip_record(rows[0], destination='1090BROKEN01')
+    departures.stops_data['1090BROKEN01'] = {'atco_code': '1090BROKEN01', 'name': 'Broken'} # no common_name
+
+    built = refresh(departures)
+    assert len(built) == len(rows) - 1
+    assert departures.stop_planner.due(STOP, [None], NOW)
+    assert STOP not in departures.stop_planner.status(NOW)
+
+
+def uncached(departures, rows, tmp_path, monkeypatch):
+    """empties the trip cache but for every row after the first, returning the first row and its trip"""
+    from tripcache import TripCache
+    missing = rows[0]
+    trip = departures.trips_data[missing.trip_id]
+    monkeypatch.setattr(departures, 'trips_data', TripCache(str(tmp_path / 'other trips.db'), legacy_path=None))
+    for row in rows[1:]:
+        departures.trips_data[row.trip_id] = trip_record(row)
+    return missing, trip
+
+
+def test_unavailable_upstream_fails_stop_and_leaves_it_due(pipeline, adapter, tmp_path, monkeypatch):
+    from bustimes import UpstreamUnavailable
+    departures, rows = pipeline
+    missing, trip = uncached(departures, rows, tmp_path, monkeypatch)
+    adapter.failing.add('/api/trips/')
+
+    assert isinstance(refresh(departures), UpstreamUnavailable)
+    assert departures.stop_planner.due(STOP, [None], NOW)
+
+    departures.trips_data[missing.trip_id] = trip
+    built = refresh(departures)
+    assert len(built) == len(rows)
+    assert not departures.stop_planner.due(STOP, [None], NOW)
+
+
+def test_trip_not_found_skips_its_row(pipeline, tmp_path, monkeypatch):
+    departures, rows = pipeline
+    uncached(departures, rows, tmp_path, monkeypatch) # and no fixture for it, so a 404
+
+    built = refresh(departures)
+    assert len(built) == len(rows) - 1
+    assert departures.stop_planner.due(STOP, [None], NOW)
+
+
+def test_failed_page_only_fails_groups_showing_it(pipeline):
+    from bustimes import UpstreamError
+    departures, rows = pipeline
+    groups = {
+        'fine': {'stops': {STOP: {}}},
+        'broken': {'stops': {STOP: {}, '1090GONE': {'type': 'station'}}}, # no fixture, so a 404
+    }
+    summaries = departures.get_group_departures(groups)
+    departures.snapshot_writer.flush()
+    assert isinstance(summaries['fine'], list)
+    assert isinstance(summaries['broken'], UpstreamError)
+
+
+def test_refresher_serves_a_failed_group_stale():
+    from snapshots import Refresher
+    results = {'fine': [], 'broken': []}
+    refresher = Refresher(lambda groups: {name: results[name] for name in groups})
+    refresher.add_group('fine', {}, 60)
+    refresher.add_group('broken', {}, 60)
+    refresher.refresh('fine', 'broken')
+
+    results['broken'] = RuntimeError('page gone')
+    refresher.refresh('fine', 'broken')
+    assert not refresher.groups['fine'].snapshot.stale
+    assert refresher.groups['fine'].error is None
+    assert refresher.groups['broken'].snapshot.stale
+    assert refresher.groups['broken'].error == 'page gone'
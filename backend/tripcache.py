@@ -0,0 +1,210 @@
+"""bounded cache of bustimes.org trip records that forgets journeys once they have run"""
+import collections
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import NamedTuple, Optional, Tuple
+
+# --- How long a trip is kept after its last timed stop, and at most after being fetched ---
+EXPIRY_GRACE = datetime.timedelta(hours=1)
+MAX_AGE = datetime.timedelta(hours=36)
+
+log = logging.getLogger(__name__)
+
+
+def trip_expiry(trip, fetched_at):
+    """returns when a trip has finished running, as a unix timestamp
+
+    Trip times are bare HH:MM strings. Trips are only fetched while they are
+    still to depart from a stop being shown, so the last time is taken to be
+    its next occurrence, allowing for a journey that finished just before the
+    fetch running late.
+    """
+    try:
+        last = trip['times'][-1]['aimed_arrival_time'] or trip['times'][-1]['aimed_departure_time']
+        last_time = datetime.datetime.strptime(last, '%H:%M').time()
+    except (KeyError, IndexError, TypeError, ValueError):
+        return (fetched_at + MAX_AGE).timestamp()
+
+    end = datetime.datetime.combine(fetched_at.date(), last_time).astimezone()
+    if end < fetched_at - EXPIRY_GRACE:
+        end += datetime.timedelta(days=1)
+    return min(end + EXPIRY_GRACE, fetched_at + MAX_AGE).timestamp()
+
+
+class TripTiming(NamedTuple):
+    """what the departure boards need from a trip, worked out once when it is cached"""
+    timing_points: Tuple[Tuple[str, datetime.time], ...]
+    circular: bool
+    destination_atco: Optional[str]
+
+
+def derive_timing(trip):
+    """returns the timing points of a trip with their aimed times parsed, plus its destination
+
+    Each principal timing point appears once, in route order, timed by its last
+    call so a circular route's start point takes its finishing time. The time
+    is the aimed departure, or the aimed arrival where there is no departure.
+    """
+    times = trip.get('times') or []
+    ptp = [t for t in times if t.get('timing_status') == 'PTP']
+
+    last_call = {}
+    for t in times:
+        try:
+            last_call[t['stop']['atco_code']] = t
+        except (KeyError, TypeError):
+            pass
+
+    timing_points = []
+    for atco_code in dict.fromkeys(t['stop']['atco_code'] for t in ptp):
+        call = last_call[atco_code]
+        aimed = call.get('aimed_departure_time') or call.get('aimed_arrival_time')
+        if aimed is None:
+            continue
+        timing_points.append((atco_code, datetime.datetime.strptime(aimed, '%H:%M').time()))
+
+    try:
+        destination_atco = str(times[-1]['stop']['atco_code'])
+    except (IndexError, KeyError, TypeError):
+        destination_atco = None
+
+    return TripTiming(
+        timing_points=tuple(timing_points),
+        circular=bool(ptp) and ptp[0]['stop']['atco_code'] == ptp[-1]['stop']['atco_code'],
+        destination_atco=destination_atco,
+    )
+
+
+class TripCache:
+    """trip records by trip id, evicted once the journey is over or past max_entries
+
+    Lookups are served from memory in least-recently-used order. Changes are
+    persisted to sqlite by flush(), so a restart picks up the unexpired trips
+    without the whole cache being rewritten each refresh.
+    """
+
+    def __init__(self, path='_data/trips.db', legacy_path='_data/trips.json', max_entries=5000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._trips = collections.OrderedDict()
+        self._expires = {}
+        self._timing = {}
+        self._dirty = set()
+        self._deleted = set()
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS trips (trip_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)')
+        self._db.commit()
+
+        empty = self._db.execute('SELECT COUNT(*) FROM trips').fetchone()[0] == 0
+        with self._db:
+            self._db.execute('DELETE FROM trips WHERE expires_at < ?', (time.time(),))
+        for trip_id, data, expires_at in self._db.execute('SELECT trip_id, data, expires_at FROM trips ORDER BY rowid'):
+            self._trips[trip_id] = json.loads(data)
+            self._expires[trip_id] = expires_at
+            self._timing[trip_id] = derive_timing(self._trips[trip_id])
+
+        if empty and legacy_path and os.path.exists(legacy_path):
+            self.migrate(legacy_path)
+
+    def migrate(self, legacy_path):
+        """one-shot import of the old trips.json cache, keeping only trips that haven't run yet"""
+        try:
+            with open(legacy_path, encoding="utf-8") as f:
+                legacy = json.loads(f.read())
+        except (json.JSONDecodeError, FileNotFoundError):
+            return 0
+        for trip_id, trip in legacy.items():
+            self[trip_id] = trip
+        self.evict()
+        written = self.flush()
+        log.info("Migrated %d trips from %s to %s", written, legacy_path, self.path)
+        return written
+
+    # --- Mapping interface ---
+
+    def __contains__(self, trip_id):
+        return trip_id in self._trips
+
+    def __getitem__(self, trip_id):
+        with self._lock:
+            trip = self._trips[trip_id]
+            self._trips.move_to_end(trip_id)
+        return trip
+
+    def __setitem__(self, trip_id, trip):
+        now = datetime.datetime.now().astimezone()
+        timing = derive_timing(trip)
+        with self._lock:
+            self._trips[trip_id] = trip
+            self._trips.move_to_end(trip_id)
+            self._expires[trip_id] = trip_expiry(trip, now)
+            self._timing[trip_id] = timing
+            self._dirty.add(trip_id)
+            self._deleted.discard(trip_id)
+
+    def __len__(self):
+        return len(self._trips)
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._trips))
+
+    def get(self, trip_id, default=None):
+        """returns a cached trip, counting the lookup as a hit or miss"""
+        try:
+            trip = self[trip_id]
+        except KeyError:
+            self.stats['misses'] += 1
+            return default
+        self.stats['hits'] += 1
+        return trip
+
+    def timing(self, trip_id):
+        """returns the TripTiming derived when the trip was cached"""
+        return self._timing[trip_id]
+
+    # --- Eviction and persistence ---
+
+    def evict(self):
+        """drops trips that have finished running, then the least recently used past max_entries"""
+        now = time.time()
+        with self._lock:
+            for trip_id in [t for t, expires_at in self._expires.items() if expires_at < now]:
+                self._drop(trip_id)
+                self.stats['expired'] += 1
+            while len(self._trips) > self.max_entries:
+                self._drop(next(iter(self._trips)))
+                self.stats['evicted'] += 1
+
+    def _drop(self, trip_id):
+        """removes a trip from memory and queues its row for deletion"""
+        del self._trips[trip_id]
+        del self._expires[trip_id]
+        del self._timing[trip_id]
+        self._dirty.discard(trip_id)
+        self._deleted.add(trip_id)
+
+    def flush(self):
+        """writes trips added and deletes trips evicted since the last flush, returning how many were written"""
+        with self._lock:
+            rows = [(t, json.dumps(self._trips[t], default=str), self._expires[t]) for t in self._dirty]
+            deleted = [(t,) for t in self._deleted]
+            self._dirty, self._deleted = set(), set()
+            if rows or deleted:
+                with self._db:
+                    self._db.executemany('INSERT OR REPLACE INTO trips (trip_id, data, expires_at) VALUES (?, ?, ?)', rows)
+                    self._db.executemany('DELETE FROM trips WHERE trip_id = ?', deleted)
+        return len(rows)
+
+    def counters(self):
+        """returns hit, miss and eviction counts along with the current size"""
+        return dict(self.stats, entries=len(self._trips), max_entries=self.max_entries)
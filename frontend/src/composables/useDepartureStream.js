@@ -0,0 +1,97 @@
+import { ref, onMounted, onUnmounted } from 'vue';
+
+const API_BASE = 'http://localhost:8000';
+
+// Wait before reopening a stream the browser gave up on, doubling up to the old 60s poll
+const RECONNECT_DELAY = 5000;
+const MAX_RECONNECT_DELAY = 60000;
+
+// Subscribes to a stop group's departures stream. The backend sends the whole list once
+// ('snapshot') and then only the departures that were added, removed or changed ('diff').
+export function useDepartureStream(group, label) {
+  const departures = ref([]);
+  const error = ref(null);
+  const isFetching = ref(true);
+  const updateKey = ref(0); // Used to force TransitionGroup re-render on data change
+  const stale = ref(false); // True while the backend can't reach bustimes.org and is replaying its last good data
+  const refreshedAt = ref(null);
+  let source = null;
+  let reconnectTimer = null;
+  let reconnectDelay = RECONNECT_DELAY;
+
+  const applyFreshness = (data) => {
+    stale.value = data.stale;
+    refreshedAt.value = new Date(data.refreshed_at);
+  };
+
+  const applySnapshot = (data) => {
+    const hasChanges = JSON.stringify(departures.value) !== JSON.stringify(data.departures);
+    departures.value = data.departures;
+    if (hasChanges) {
+      updateKey.value++; // Increment key to re-render TransitionGroup and trigger animations
+      console.log(`${label} departures data updated, triggering animation.`);
+    }
+  };
+
+  const applyDiff = (diff) => {
+    if (!diff.added.length && !diff.removed.length && !diff.changed.length) {
+      return; // Only the staleness changed
+    }
+    const byKey = new Map(departures.value.map((departure) => [departure.key, departure]));
+    diff.removed.forEach((key) => byKey.delete(key));
+    diff.added.forEach((departure) => byKey.set(departure.key, departure));
+    diff.changed.forEach((departure) => byKey.set(departure.key, departure));
+    departures.value = diff.order.map((key) => byKey.get(key));
+    updateKey.value++;
+    console.log(
+      `${label} departures changed: ${diff.added.length} added, ${diff.removed.length} removed, ${diff.changed.length} changed.`
+    );
+  };
+
+  const connect = () => {
+    source = new EventSource(`${API_BASE}/departures/${group}/stream`);
+
+    source.addEventListener('snapshot', (event) => {
+      const data = JSON.parse(event.data);
+      applyFreshness(data);
+      applySnapshot(data);
+      error.value = null;
+      isFetching.value = false;
+      reconnectDelay = RECONNECT_DELAY;
+    });
+
+    source.addEventListener('diff', (event) => {
+      const diff = JSON.parse(event.data);
+      applyFreshness(diff);
+      applyDiff(diff);
+    });
+
+    // EventSource only reconnects by itself after a network error. An error response, e.g. a 500
+    // on a cold start while bustimes.org is down, closes it for good, so reopen it after a backoff.
+    // The backend starts every connection with a snapshot either way.
+    source.onerror = (err) => {
+      console.error(`Error streaming ${label} departures:`, err);
+      error.value = `Failed to load ${label} departures. Reconnecting... (Check backend)`;
+      isFetching.value = false;
+      if (source.readyState === EventSource.CLOSED) {
+        source.close();
+        clearTimeout(reconnectTimer);
+        reconnectTimer = setTimeout(connect, reconnectDelay);
+        reconnectDelay = Math.min(reconnectDelay * 2, MAX_RECONNECT_DELAY);
+      }
+    };
+  };
+
+  onMounted(() => {
+    connect();
+  });
+
+  onUnmounted(() => {
+    clearTimeout(reconnectTimer);
+    if (source) {
+      source.close();
+    }
+  });
+
+  return { departures, error, isFetching, updateKey, stale, refreshedAt };
+}